@@ -0,0 +1,716 @@
+#!/usr/bin/env python
+"""timings for reitercurse, for spotting regressions and improvements.
+Run it directly:
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --quick fact quicksort
+    python benchmarks.py --baseline results.json --tolerance 1.5
+
+Each workload is run at several sizes in four ways: decorated with
+execute_iteratively, as plain recursion with the recursion limit raised,
+decorated with functools.lru_cache, and as a hand written loop.  For each,
+the wall time, the number of times the function body (or the loop body)
+ran and the peak memory traced by tracemalloc are recorded.  With
+--baseline, the exit status is 1 if the execute_iteratively timings, body
+counts or peak memory regressed beyond the tolerance.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import OrderedDict
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # not available before Python 3.2
+    lru_cache = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # not available before Python 3.4
+    tracemalloc = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # not available before Python 3.2
+    ProcessPoolExecutor = None
+
+if ProcessPoolExecutor is not None and 'fork' in multiprocessing.get_all_start_methods():
+    # worker processes started any other way import this module afresh,
+    # and don't see parallel_quicksort as decorated at runtime
+    fork_context = multiprocessing.get_context('fork')
+else:
+    fork_context = None
+
+from reitercurse import (
+    RedemptionToken,
+    SqliteStore,
+    UnknownValue,
+    execute_iteratively,
+)
+
+
+def fn(n):
+    return n
+
+
+def trap_with_unknown_value():
+    unknown = UnknownValue(fn, RedemptionToken(10))
+    return unknown * 10 + 1
+
+
+def trap_with_magic_mock():
+    # what every trapped call used to cost: a brand new MagicMock subclass,
+    # an instance of it, and child mocks for each operator in the expression
+    from mock import MagicMock
+    redemption_token = RedemptionToken(10)
+
+    class TaggedUnknownValue(MagicMock):
+        def __init__(self, *args, **kwargs):
+            super(TaggedUnknownValue, self).__init__(
+                defining_function=fn,
+                redemption_token=redemption_token,
+            )
+    return TaggedUnknownValue() * 10 + 1
+
+
+def per_call(stmt, number):
+    return min(timeit.repeat(stmt, number=number, repeat=3)) / number
+
+
+def bench_trap_cost():
+    results = {'UnknownValue': per_call(trap_with_unknown_value, 100000)}
+    try:
+        import mock
+    except ImportError:
+        pass
+    else:
+        results['MagicMock'] = per_call(trap_with_magic_mock, 1000)
+    return results
+
+
+def bench_cache_hit():
+    """seconds for a call whose result is already memoized, which is mostly
+    the cost of making and hashing its RedemptionToken"""
+    @execute_iteratively
+    def ifib(n):
+        if n < 3:
+            return n
+        return ifib(n - 1) + ifib(n - 2)
+
+    @execute_iteratively
+    def total(values):
+        return sum(values)
+
+    @execute_iteratively(key=lambda values: len(values))
+    def keyed_total(values):
+        return sum(values)
+
+    values = list(range(20))
+    ifib(100)
+    total(values)
+    keyed_total(values)
+    return {
+        'int argument': per_call(lambda: ifib(50), 100000),
+        'list argument': per_call(lambda: total(values), 100000),
+        'list with key=': per_call(lambda: keyed_total(values), 100000),
+    }
+
+
+def bench_tabulation(size):
+    """seconds for ifib(size) evaluated top down on the stack, then
+    tabulated bottom up over a domain"""
+    timings = []
+    for name, options in (('stack', {}), ('domain', {'domain': [size + 1]})):
+        @execute_iteratively(**options)
+        def ifib(n):
+            if n < 3:
+                return n
+            return ifib(n - 1) + ifib(n - 2)
+        began = time.time()
+        ifib(size)
+        timings.append((name, time.time() - began))
+    return timings
+
+
+def bench_map(size):
+    """seconds for ifib(n) for every n below 'size', called one at a time,
+    then all together with map, for the default memo and for one that keeps
+    nothing between calls"""
+    timings = []
+    for cache in ('memo', 'evaluation'):
+        for name in ('loop', 'map'):
+            @execute_iteratively(cache=cache)
+            def ifib(n):
+                if n < 3:
+                    return n
+                return ifib(n - 1) + ifib(n - 2)
+            began = time.time()
+            if name == 'loop':
+                [ifib(n) for n in range(size)]
+            else:
+                ifib.map(range(size))
+            timings.append(('%s, %s' % (cache, name), time.time() - began))
+    return timings
+
+
+def count_body_invocations(size):
+    bodies = [0]
+
+    @execute_iteratively
+    def split_sum(low, high):
+        bodies[0] += 1
+        if high - low == 1:
+            return low
+        middle = (low + high) // 2
+        return split_sum(low, middle) + split_sum(middle, high)
+
+    split_sum(0, size)
+    return bodies[0]
+
+
+def bench_store_warm_start(size):
+    """seconds for the first call against an empty store, then for the same
+    call from a fresh decoration (as in a new process) against the filled
+    store"""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'memo.sqlite')
+        timings = []
+        for start in ('cold', 'warm'):
+            @execute_iteratively(store=SqliteStore(path))
+            def ifib(n):
+                if n < 3:
+                    return n
+                return ifib(n - 1) + ifib(n - 2)
+            began = time.time()
+            ifib(size)
+            timings.append((start, time.time() - began))
+        return timings
+    finally:
+        shutil.rmtree(directory)
+
+
+def parallel_quicksort(value_sequence):
+    # decorated by bench_parallel, workers in other processes have to be
+    # able to find it by name, and so are forked from the process that
+    # decorated it
+    if not value_sequence:
+        return []
+    pivots = [x for x in value_sequence if x == value_sequence[0]]
+    lesser = parallel_quicksort([x for x in value_sequence if x < value_sequence[0]])
+    greater = parallel_quicksort([x for x in value_sequence if x > value_sequence[0]])
+    return lesser + pivots + greater
+
+
+def bench_parallel(size):
+    """seconds to quicksort 'size' shuffled values serially, then with
+    ProcessPoolExecutors of 1, 2, 4... forked workers, up to the number of
+    cores (and at least 2).  How the times fall as workers are added shows
+    how the parallel mode scales with cores."""
+    global parallel_quicksort
+    if fork_context is None:
+        return []
+    values = list(range(size))
+    random.Random(0).shuffle(values)
+    cores = multiprocessing.cpu_count()
+    raw_quicksort = parallel_quicksort
+    timings = []
+    try:
+        parallel_quicksort = execute_iteratively(raw_quicksort)
+        began = time.time()
+        parallel_quicksort(values)
+        timings.append(('serial', time.time() - began))
+        workers = 1
+        while workers <= max(cores, 2):
+            executor = ProcessPoolExecutor(workers, mp_context=fork_context)
+            try:
+                parallel_quicksort = execute_iteratively(
+                    raw_quicksort,
+                    parallel=executor,
+                    parallel_threshold=size // 64,
+                    parallel_grain=size // (4 * workers),
+                    cost=len
+                )
+                # the workers are started before the clock is
+                list(executor.map(abs, range(workers)))
+                began = time.time()
+                parallel_quicksort(values)
+                timings.append(('%d workers' % workers, time.time() - began))
+            finally:
+                executor.shutdown()
+            workers *= 2
+    finally:
+        parallel_quicksort = raw_quicksort
+    return timings
+
+
+class Node(object):
+    """a tree node or a linked list cell, hashed by identity"""
+    __slots__ = ('value', 'left', 'right')
+
+    def __init__(self, value, left=None, right=None):
+        self.value = value
+        self.left = left
+        self.right = right
+
+
+def leaning_tree(size):
+    """a tree 'size' levels deep, each level a leaf and a deeper subtree"""
+    tree = Node(0)
+    for value in range(1, size):
+        tree = Node(value, Node(-value), tree)
+    return tree
+
+
+def linked_list(size):
+    cells = None
+    for value in range(size):
+        cells = Node(value, cells)
+    return cells
+
+
+def make_fact(decorate, bodies):
+    @decorate
+    def fact(n):
+        bodies[0] += 1
+        if n < 2:
+            return 1
+        return fact(n - 1) * n
+    return fact
+
+
+def loop_fact(bodies):
+    def fact(n):
+        result = 1
+        for x in range(2, n + 1):
+            bodies[0] += 1
+            result *= x
+        return result
+    return fact
+
+
+def make_fib(decorate, bodies):
+    @decorate
+    def fib(n):
+        bodies[0] += 1
+        if n < 3:
+            return n
+        return fib(n - 1) + fib(n - 2)
+    return fib
+
+
+def make_mutual_fib(decorate, bodies):
+    @decorate
+    def ifib1(n):
+        bodies[0] += 1
+        if n < 3:
+            return n
+        return ifib1(n - 1) + ifib2(n - 2)
+
+    @decorate
+    def ifib2(n):
+        bodies[0] += 1
+        if n < 3:
+            return n
+        return ifib2(n - 1) + ifib1(n - 2)
+    return ifib1
+
+
+def loop_fib(bodies):
+    def fib(n):
+        a, b = 1, 2
+        if n < 3:
+            return n
+        for x in range(n - 2):
+            bodies[0] += 1
+            a, b = b, a + b
+        return b
+    return fib
+
+
+def make_quicksort(decorate, bodies):
+    @decorate
+    def quicksort(value_sequence):
+        bodies[0] += 1
+        if not value_sequence:
+            return []
+        pivots = [x for x in value_sequence if x == value_sequence[0]]
+        lesser = quicksort([x for x in value_sequence if x < value_sequence[0]])
+        greater = quicksort([x for x in value_sequence if x > value_sequence[0]])
+        return lesser + pivots + greater
+    return quicksort
+
+
+def loop_quicksort(bodies):
+    def quicksort(value_sequence):
+        result = []
+        # partitions still to be sorted, and pivots ready to be output,
+        # with the leftmost on top
+        pending = [(False, list(value_sequence))]
+        while pending:
+            bodies[0] += 1
+            is_sorted, values = pending.pop()
+            if is_sorted:
+                result.extend(values)
+            elif values:
+                pending.append((False, [x for x in values if x > values[0]]))
+                pending.append((True, [x for x in values if x == values[0]]))
+                pending.append((False, [x for x in values if x < values[0]]))
+        return result
+    return quicksort
+
+
+def make_ackermann(decorate, bodies):
+    @decorate
+    def ackermann(m, n):
+        bodies[0] += 1
+        if m == 0:
+            return n + 1
+        if n == 0:
+            return ackermann(m - 1, 1)
+        return ackermann(m - 1, ackermann(m, n - 1))
+    return lambda n: ackermann(3, n)
+
+
+def loop_ackermann(bodies):
+    def ackermann(n):
+        # the m of every pending outer call, the innermost on top
+        pending = [3]
+        while pending:
+            bodies[0] += 1
+            m = pending.pop()
+            if m == 0:
+                n += 1
+            elif n == 0:
+                pending.append(m - 1)
+                n = 1
+            else:
+                pending.append(m - 1)
+                pending.append(m)
+                n -= 1
+        return n
+    return ackermann
+
+
+def make_tree_sum(decorate, bodies):
+    @decorate
+    def tree_sum(node):
+        bodies[0] += 1
+        if node is None:
+            return 0
+        return node.value + tree_sum(node.left) + tree_sum(node.right)
+    return tree_sum
+
+
+def loop_tree_sum(bodies):
+    def tree_sum(node):
+        total = 0
+        pending = [node]
+        while pending:
+            bodies[0] += 1
+            node = pending.pop()
+            if node is not None:
+                total += node.value
+                pending.append(node.right)
+                pending.append(node.left)
+        return total
+    return tree_sum
+
+
+def make_list_sum(decorate, bodies):
+    @decorate
+    def list_sum(cells):
+        bodies[0] += 1
+        if cells is None:
+            return 0
+        return cells.value + list_sum(cells.left)
+    return list_sum
+
+
+def loop_list_sum(bodies):
+    def list_sum(cells):
+        total = 0
+        while cells is not None:
+            bodies[0] += 1
+            total += cells.value
+            cells = cells.left
+        return total
+    return list_sum
+
+
+def descending(size):
+    return list(range(size, 0, -1))
+
+
+def identity(n):
+    return n
+
+
+# name: (recursive form, hand written loop, input for a size, sizes, quick
+# sizes, the largest size worth trying for variants with no memo that take
+# exponential time)
+WORKLOADS = OrderedDict([
+    ('fact', (make_fact, loop_fact, identity, (500, 2000, 5000), (500,), {})),
+    ('fib', (make_fib, loop_fib, identity, (20, 1000, 5000), (20, 500), {'recursion': 20})),
+    ('mutual_fib', (make_mutual_fib, loop_fib, identity, (20, 1000, 5000), (20, 500), {'recursion': 20})),
+    ('quicksort', (make_quicksort, loop_quicksort, descending, (100, 1000, 3000), (100, 500), {})),
+    ('ackermann', (make_ackermann, loop_ackermann, identity, (3, 6, 9), (3, 5), {'recursion': 7, 'loop': 7})),
+    ('tree_sum', (make_tree_sum, loop_tree_sum, leaning_tree, (1000, 10000, 50000), (1000,), {})),
+    ('list_sum', (make_list_sum, loop_list_sum, linked_list, (1000, 10000, 100000), (1000,), {})),
+])
+
+VARIANTS = ('execute_iteratively', 'recursion', 'lru_cache', 'loop')
+
+# tracemalloc gets slower the deeper the Python stack is, to the point of
+# never finishing once plain recursion is tens of thousands of frames deep.
+# Sizes stand in for depths, which they roughly are for every workload.
+DEEPEST_TRACED = 10000
+
+
+def make_variant(variant, workload, bodies):
+    """return the function for one way of running a workload, or a reason
+    why that way doesn't apply"""
+    make_recursive, make_loop = WORKLOADS[workload][:2]
+    if variant == 'execute_iteratively':
+        return make_recursive(execute_iteratively, bodies)
+    if variant == 'recursion':
+        return make_recursive(lambda fn: fn, bodies)
+    if variant == 'lru_cache':
+        if lru_cache is None:
+            return 'functools.lru_cache is not available'
+        if workload == 'quicksort':
+            return 'lists are not hashable'
+        return make_recursive(lru_cache(maxsize=None), bodies)
+    return make_loop(bodies)
+
+
+def measure(workload, variant, size, repeat):
+    """run one workload one way at one size.  Each run starts with a newly
+    decorated function, so that no memo carries over."""
+    make_input, sizes, quick_sizes, largest_without_memo = WORKLOADS[workload][2:]
+    record = OrderedDict([
+        ('workload', workload),
+        ('variant', variant),
+        ('size', size),
+    ])
+    if size > largest_without_memo.get(variant, size):
+        record['skipped'] = 'too slow without a memo'
+        return record, None
+    argument = make_input(size)
+    timings = []
+    try:
+        for x in range(repeat):
+            bodies = [0]
+            fn = make_variant(variant, workload, bodies)
+            if not callable(fn):
+                record['skipped'] = fn
+                return record, None
+            began = time.time()
+            result = fn(argument)
+            timings.append(time.time() - began)
+        record['seconds'] = min(timings)
+        record['bodies'] = bodies[0]
+        if variant in ('recursion', 'lru_cache') and size > DEEPEST_TRACED:
+            record['peak_bytes_skipped'] = 'too deep for tracemalloc'
+        elif tracemalloc is not None:
+            fn = make_variant(variant, workload, [0])
+            tracemalloc.start()
+            try:
+                fn(argument)
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    except (RuntimeError, MemoryError) as x:
+        # RecursionError is a RuntimeError
+        record['error'] = '%s: %s' % (type(x).__name__, x)
+        return record, None
+    return record, result
+
+
+def run_workloads(workloads, quick, repeat):
+    records = []
+    for workload in workloads:
+        sizes = WORKLOADS[workload][4 if quick else 3]
+        for size in sizes:
+            results = {}
+            for variant in VARIANTS:
+                record, results[variant] = measure(workload, variant, size, repeat)
+                records.append(record)
+                sys.stderr.write('%-12s %7d %-20s %s\n' % (
+                    workload,
+                    size,
+                    variant,
+                    describe(record)
+                ))
+            answers = [x for x in results.values() if x is not None]
+            if any(x != answers[0] for x in answers):
+                raise AssertionError(
+                    '%s(%d) gave different answers: %r' % (
+                        workload,
+                        size,
+                        results
+                    )
+                )
+    return records
+
+
+def describe(record):
+    if 'skipped' in record:
+        return 'skipped, %s' % record['skipped']
+    if 'error' in record:
+        return record['error']
+    description = '%10.3f ms %10d bodies' % (
+        record['seconds'] * 1e3,
+        record['bodies']
+    )
+    if 'peak_bytes' in record:
+        description += ' %12d peak bytes' % record['peak_bytes']
+    return description
+
+
+def in_deep_thread(fn, *args):
+    """call fn on a thread with a large stack and a high recursion limit, so
+    that plain recursion gets as far as it can before failing"""
+    results = []
+    previous_limit = sys.getrecursionlimit()
+    previous_stack_size = threading.stack_size()
+    try:
+        threading.stack_size(512 * 1024 * 1024)
+    except (ValueError, RuntimeError):
+        pass
+    sys.setrecursionlimit(1000000)
+    try:
+        thread = threading.Thread(target=lambda: results.append(fn(*args)))
+        thread.start()
+        thread.join()
+    finally:
+        sys.setrecursionlimit(previous_limit)
+        threading.stack_size(previous_stack_size)
+    if not results:
+        raise RuntimeError('the benchmarks failed, see above')
+    return results[0]
+
+
+def run_micro():
+    micro = OrderedDict()
+    for name, seconds in sorted(bench_trap_cost().items()):
+        micro['trap cost, %s' % name] = seconds
+    for name, seconds in sorted(bench_cache_hit().items()):
+        micro['cache hit, %s' % name] = seconds
+    for name, seconds in bench_tabulation(5000):
+        micro['ifib(5000) on the %s' % name] = seconds
+    for name, seconds in bench_map(300):
+        micro['ifib(0..299) with cache=%s' % name] = seconds
+    for start, seconds in bench_store_warm_start(5000):
+        micro['ifib(5000) with SqliteStore, %s start' % start] = seconds
+    for name, seconds in bench_parallel(20000):
+        micro['quicksort(20000), %s' % name] = seconds
+    for name, seconds in micro.items():
+        sys.stderr.write('%-40s %10.3f us\n' % (name, seconds * 1e6))
+    return micro
+
+
+def regressions(baseline, current, tolerance):
+    """describe how the execute_iteratively records of 'current' are worse
+    than those of 'baseline'.  Times and peak memory may grow by a factor of
+    'tolerance', body counts may not grow at all."""
+    before = dict(
+        ((x['workload'], x['size']), x)
+        for x in baseline['workloads']
+        if x['variant'] == 'execute_iteratively'
+    )
+    found = []
+    for after in current['workloads']:
+        if after['variant'] != 'execute_iteratively':
+            continue
+        old = before.get((after['workload'], after['size']))
+        if old is None or 'seconds' not in old:
+            continue
+        name = '%s(%d)' % (after['workload'], after['size'])
+        if 'seconds' not in after:
+            found.append('%s: %s' % (name, after.get('error')))
+            continue
+        if after['seconds'] > old['seconds'] * tolerance:
+            found.append('%s: %.3f ms, was %.3f ms' % (
+                name,
+                after['seconds'] * 1e3,
+                old['seconds'] * 1e3
+            ))
+        if after['bodies'] > old['bodies']:
+            found.append('%s: %d bodies, was %d' % (
+                name,
+                after['bodies'],
+                old['bodies']
+            ))
+        if 'peak_bytes' in after and 'peak_bytes' in old and after['peak_bytes'] > old['peak_bytes'] * tolerance:
+            found.append('%s: %d peak bytes, was %d' % (
+                name,
+                after['peak_bytes'],
+                old['peak_bytes']
+            ))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark reitercurse')
+    parser.add_argument(
+        'workloads',
+        nargs='*',
+        help='the workloads to run, all of them by default: %s' % ', '.join(WORKLOADS)
+    )
+    parser.add_argument('--quick', action='store_true', help='small sizes only')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the fastest is kept')
+    parser.add_argument('--output', help='write the results here as JSON, rather than to stdout')
+    parser.add_argument('--no-micro', action='store_true', help='skip the micro benchmarks')
+    parser.add_argument('--baseline', help='JSON written by an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='how much slower or bigger than the baseline is acceptable')
+    options = parser.parse_args(argv)
+    for workload in options.workloads:
+        if workload not in WORKLOADS:
+            parser.error('there is no %r workload' % workload)
+
+    results = OrderedDict([
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('platform', platform.platform()),
+        ('workloads', in_deep_thread(
+            run_workloads,
+            options.workloads or list(WORKLOADS),
+            options.quick,
+            options.repeat
+        )),
+    ])
+    if not options.no_micro:
+        results['micro'] = run_micro()
+
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            found = regressions(json.load(baseline), results, options.tolerance)
+        for a_regression in found:
+            sys.stderr.write('regression: %s\n' % a_regression)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
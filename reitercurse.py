@@ -7,27 +7,167 @@ problems, can't-get-there-from-here situations, or other such troubles.
 There is no warranty, no guarantee, and the author is absentee."""
 
 
-from mock import MagicMock
-from functools import wraps
+from collections import namedtuple, OrderedDict
+from functools import update_wrapper, wraps
+from timeit import default_timer
 
+import array
+import hashlib
+import json
+import pickle
+import sqlite3
+import sys
+import tempfile
 import threading
+import time
+import types
 
-class UnknownValue(MagicMock):
+try:
+    import numpy
+except ImportError:
+    # only needed for vectorized tabulation, which works without it
+    numpy = None
+
+if sys.version_info[0] < 3:
+    integer_types = (int, long)
+else:
+    integer_types = (int,)
+
+_set_slot = object.__setattr__
+
+# shared by every RedemptionToken of a call without kwargs, rather than one
+# empty dict each.  It is only ever unpacked, never changed.
+_no_kwargs = {}
+
+class UnknownValue(object):
     """instances of this class are used to represent a value that cannot be
     calculated at the current moment. It is a placeholder.  It is to be
     returned by calls to recursive functions to stop them from recursing.
-    It is based on MagicMock because MagicMock is a class that can survive
-    without error from statements like this:
+    It absorbs arithmetic, comparison, indexing, attribute and call operators
+    by returning itself, so it can survive without error from statements like
+    this:
 
         def recursive_method(x):
             # ...
             return recursive_method(x - 1) * 10 + recursive_method(x - 2) * 100
 
-    The MagicMock captures the entire expression and returns an new instance
-    of MagicMock.  Instance are placeholders only. No reconstruction of the
-    expression is attempted from the MagicMock, it's just a thing that survives.
+    The whole expression collapses back into the very same UnknownValue, so
+    it still carries the context of the original call.  Instances are
+    placeholders only. No reconstruction of the expression is attempted, it's
+    just a thing that survives.
+
+    Conversions that Python insists must return a real type (int, float,
+    len, iter, ...) return the same neutral values that MagicMock used to.
     """
-    pass
+    __slots__ = ('defining_function', 'redemption_token')
+
+    def __init__(self, defining_function, redemption_token):
+        _set_slot(self, 'defining_function', defining_function)
+        _set_slot(self, 'redemption_token', redemption_token)
+
+    def __repr__(self):
+        return str((
+            self.defining_function.__name__,
+            self.redemption_token.args,
+            self.redemption_token.kwargs
+        ))
+
+    def __getattr__(self, name):
+        # only reached for attributes that don't exist.  Protocol probes
+        # (__length_hint__, __getstate__, ...) must still fail normally
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError(name)
+        return self
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __delattr__(self, name):
+        pass
+
+    __hash__ = object.__hash__
+
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+    def __len__(self):
+        return 0
+
+    def __iter__(self):
+        return iter(())
+
+    def __contains__(self, item):
+        return False
+
+    def __int__(self):
+        return 1
+    __long__ = __index__ = __int__
+
+    def __float__(self):
+        return 1.0
+
+    def __complex__(self):
+        return 1j
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __delitem__(self, key):
+        pass
+
+    def __exit__(self, *args):
+        return False
+
+    def __await__(self):
+        # within an 'async def' function under execute_as_generator
+        return AwaitedCall(self)
+
+def _absorb(self, *args, **kwargs):
+    return self
+
+for _name in (
+    'add', 'sub', 'mul', 'div', 'truediv', 'floordiv', 'mod', 'divmod',
+    'pow', 'lshift', 'rshift', 'and', 'xor', 'or', 'matmul',
+):
+    setattr(UnknownValue, '__%s__' % _name, _absorb)
+    setattr(UnknownValue, '__r%s__' % _name, _absorb)
+    setattr(UnknownValue, '__i%s__' % _name, _absorb)
+for _name in (
+    'neg', 'pos', 'abs', 'invert', 'round', 'trunc', 'floor', 'ceil',
+    'lt', 'le', 'eq', 'ne', 'gt', 'ge',
+    'getitem', 'getslice', 'call', 'enter',
+):
+    setattr(UnknownValue, '__%s__' % _name, _absorb)
+del _name
+
+
+def freeze(value):
+    """return a hashable stand in for 'value' that compares equal whenever
+    the values do.  Lists and other iterables become tuples, dicts become
+    frozensets of their items and sets become frozensets, all the way down
+    through nested containers.  Each is paired with the type it came from,
+    so that a dict doesn't pass for a set of pairs, nor a list for a tuple.
+    An argument that is itself such a pair, like (list, (1, 2)), is
+    mistaken for the frozen form of the list."""
+    if type(value).__hash__ is not None:
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            # a tuple, or the like, holding something that isn't hashable
+            pass
+    if isinstance(value, dict):
+        return (dict, frozenset((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return (set, frozenset(value))
+    frozen = tuple(value)
+    try:
+        # usually a list of hashable things, which needs no more than this
+        hash(frozen)
+        return (type(value), frozen)
+    except TypeError:
+        return (type(value), tuple([freeze(x) for x in frozen]))
 
 
 class RedemptionToken(object):
@@ -35,116 +175,1917 @@ class RedemptionToken(object):
     UnknownValue.  It encapsulates a static form of args/kwargs from a call to
     a recursive function.  To redeem, the args/kwargs are passed to the
     recursive function and that function will either return a value or a new
-    UnknownValue."""
-    def __init__(self, *args, **kwargs):
-            self.args = args
+    UnknownValue.
 
-            args_list = []
-            for x in args:
-                if hasattr(x, '__hash__') and x.__hash__:
-                    args_list.append(x)
-                else:
-                    # not necessarily the best way to freeze a
-                    # mutable item - it assumes the mutable is a list
-                    # of immutables
-                    args_list.append(tuple(x))
-            self.static_args = tuple(args_list)
+    One of these is made for every call of a decorated function, cache hits
+    included, so the common case of hashable positional args is kept short.
+    Anything else is frozen (see freeze)."""
+    __slots__ = ('args', 'kwargs', 'static_args', 'static_kwargs', 'hash_value')
 
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        if kwargs:
             self.kwargs = kwargs
-            kwargs_list = []
-            for k, v in kwargs.iteritems():
-                if hasattr(v, '__hash__') and v.__hash__:
-                    kwargs_list.append((k, v))
-                else:
-                    # not necessarily the best way to freeze a
-                    # mutable item - it assumes the mutable is a dict
-                    # and that no state information is held within the
-                    # values of the dict
-                    kwargs_list.append ((k, tuple(v)))
-            self.static_kwargs = tuple(kwargs_list)
+            self.static_args = freeze(args)
+            self.static_kwargs = freeze(kwargs)
+            self.hash_value = hash((self.static_args, self.static_kwargs))
+            return
+        self.kwargs = _no_kwargs
+        self.static_kwargs = ()
+        for x in args:
+            if type(x).__hash__ is None:
+                # a list or the like, so the exception below is certain
+                break
+        else:
+            try:
+                self.hash_value = hash((args, ()))
+                self.static_args = args
+                return
+            except TypeError:
+                # a tuple, or the like, holding something that isn't hashable
+                pass
+        self.static_args = tuple([freeze(x) for x in args])
+        self.hash_value = hash((self.static_args, ()))
+
+    @classmethod
+    def with_key(cls, key, args, kwargs):
+        """make a token for args/kwargs that is identified by 'key' alone,
+        a hashable value standing in for the arguments"""
+        token = cls.__new__(cls)
+        token.args = args
+        token.kwargs = kwargs
+        token.static_args = (key,)
+        token.static_kwargs = ()
+        token.hash_value = hash(((key,), ()))
+        return token
 
     def __iter__(self):
         yield self.args
         yield self.kwargs
 
     def __hash__(self):
+        return self.hash_value
+
+    def __eq__(self, other):
+        return (
+            self is other
+            or self.static_args == other.static_args
+            and self.static_kwargs == other.static_kwargs
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class TailCall(object):
+    """what a function decorated with execute_iteratively(tail=True) gets
+    back from calling itself, while its body is run by the tail loop.  The
+    body returns it in place of a result, and the loop runs the body again
+    with these args/kwargs.  Unlike an UnknownValue, it absorbs nothing, so
+    a call that wasn't in tail position after all fails loudly."""
+    __slots__ = ('args', 'kwargs')
+
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+
+class ResultCache(dict):
+    """the memo of results for one decorated function within one thread,
+    keyed by RedemptionToken.  This default form never forgets anything.
+
+    Tokens can be pinned while a frame of the evaluation in progress still
+    waits to be replayed with their values.  A pinned entry must survive any
+    eviction, otherwise the replay would find the value gone, trap again and
+    recompute it, possibly forever."""
+    maxsize = None
+    # whether an unpinned entry may be dropped
+    may_forget = False
+
+    def __init__(self):
+        super(ResultCache, self).__init__()
+        self.hits = 0
+        self.misses = 0
+        self.pins = {}
+
+    def pin(self, token):
+        self.pins[token] = self.pins.get(token, 0) + 1
+
+    def unpin(self, token):
+        remaining_pins = self.pins[token] - 1
+        if remaining_pins:
+            self.pins[token] = remaining_pins
+        else:
+            del self.pins[token]
+
+    def claim(self, token):
+        """announce that the calling thread is about to compute the result
+        for 'token'.  Only a cache shared between threads can answer that
+        another thread is already at it (see SharedResultCache)."""
+        return None
+
+    def abandon(self, token):
+        """withdraw a claim after the computation has failed"""
+        pass
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def clear(self):
+        super(ResultCache, self).clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class BoundedResultCache(ResultCache):
+    """a ResultCache that holds no more than 'maxsize' unpinned entries.  The
+    oldest unpinned entry is evicted to make room: oldest by last use for the
+    'lru' policy, oldest by insertion for the 'fifo' policy.  Pinned entries
+    are set aside from eviction altogether, rejoining the others as the
+    youngest once unpinned, so while an evaluation is in progress the cache
+    may hold more than 'maxsize' entries."""
+    policies = ('lru', 'fifo')
+    may_forget = True
+
+    def __init__(self, maxsize, policy='lru'):
+        super(BoundedResultCache, self).__init__()
+        self.maxsize = maxsize
+        self.policy = policy
+        # the unpinned entries, oldest first
+        self.age_order = OrderedDict()
+
+    def __getitem__(self, token):
+        result = super(BoundedResultCache, self).__getitem__(token)
+        if self.policy == 'lru' and token in self.age_order:
+            del self.age_order[token]
+            self.age_order[token] = None
+        return result
+
+    def __setitem__(self, token, result):
+        super(BoundedResultCache, self).__setitem__(token, result)
+        if token not in self.pins:
+            self.age_order.pop(token, None)
+            self.age_order[token] = None
+            self.evict()
+
+    def __delitem__(self, token):
+        super(BoundedResultCache, self).__delitem__(token)
+        self.age_order.pop(token, None)
+
+    def pin(self, token):
+        super(BoundedResultCache, self).pin(token)
+        self.age_order.pop(token, None)
+
+    def unpin(self, token):
+        super(BoundedResultCache, self).unpin(token)
+        if token not in self.pins and token in self:
+            self.age_order[token] = None
+            self.evict()
+
+    def evict(self):
+        while len(self.age_order) > self.maxsize:
+            token = next(iter(self.age_order))
+            del self[token]
+
+    def clear(self):
+        super(BoundedResultCache, self).clear()
+        self.age_order.clear()
+
+
+class EvaluationResultCache(ResultCache):
+    """a ResultCache that holds a result only while some frame of the
+    evaluation in progress is still waiting to be replayed with it.  The
+    pins are reference counts of those waiting frames; when the last one
+    has its own result, the entry is dropped.  A result nobody is waiting
+    for, such as that of the original client call, is never stored at all.
+
+    Nothing outlives the evaluation that computed it, so intermediate values
+    that are read exactly once by their parent (sublists in a quicksort, for
+    example) are freed as soon as the parent is done with them.  The price is
+    that a value wanted again after it was dropped gets recomputed."""
+    may_forget = True
+
+    def __setitem__(self, token, result):
+        if token in self.pins:
+            super(EvaluationResultCache, self).__setitem__(token, result)
+
+    def unpin(self, token):
+        super(EvaluationResultCache, self).unpin(token)
+        if token not in self.pins:
+            self.pop(token, None)
+
+
+class SharedResultCache(object):
+    """the memo of results for one decorated function, shared by every
+    thread in the process.  Results are spread over a number of stripes, each
+    with its own lock, so that threads storing results seldom contend.
+    Reading a result takes no lock at all.
+
+    Each thread still evaluates on its own ExecutionStack.  Before a thread
+    executes a body, it claims the token.  A thread that finds a token
+    already claimed by another thread waits for that thread's result rather
+    than computing it a second time.  Any frame a thread waits on is a
+    descendant of every frame it has claimed, so threads can only wait on
+    each other in a circle if the function recurses forever anyway.
+
+    The hit and miss counts are not guarded by locks and so are only
+    approximate under contention."""
+    maxsize = None
+    may_forget = False
+    settled = threading.Event()
+    settled.set()
+
+    def __init__(self, number_of_stripes=16):
+        self.hits = 0
+        self.misses = 0
+        self.results = [{} for x in range(number_of_stripes)]
+        self.locks = [threading.Lock() for x in range(number_of_stripes)]
+        # tokens being computed: token -> (owning thread, Event)
+        self.in_flight = [{} for x in range(number_of_stripes)]
+
+    def stripe(self, token):
+        return hash(token) % len(self.results)
+
+    def __getitem__(self, token):
+        return self.results[self.stripe(token)][token]
+
+    def __setitem__(self, token, result):
+        stripe = self.stripe(token)
+        with self.locks[stripe]:
+            self.results[stripe][token] = result
+            claim = self.in_flight[stripe].pop(token, None)
+        if claim is not None:
+            claim[1].set()
+
+    def __contains__(self, token):
+        return token in self.results[self.stripe(token)]
+
+    def __len__(self):
+        return sum(len(results) for results in self.results)
+
+    def pop(self, token, *default):
+        stripe = self.stripe(token)
+        with self.locks[stripe]:
+            return self.results[stripe].pop(token, *default)
+
+    def pin(self, token):
+        # nothing is ever evicted, so nothing needs protecting
+        pass
+
+    def unpin(self, token):
+        pass
+
+    def claim(self, token):
+        """return None if the calling thread should go ahead and compute the
+        result for 'token', or an Event to wait on if the result is already
+        known or is being computed by another thread."""
+        stripe = self.stripe(token)
+        this_thread = threading.current_thread()
+        with self.locks[stripe]:
+            if token in self.results[stripe]:
+                return self.settled
+            claim = self.in_flight[stripe].get(token)
+            if claim is None:
+                self.in_flight[stripe][token] = (this_thread, threading.Event())
+                return None
+        if claim[0] is this_thread:
+            return None
+        return claim[1]
+
+    def abandon(self, token):
+        stripe = self.stripe(token)
+        with self.locks[stripe]:
+            claim = self.in_flight[stripe].get(token)
+            if claim is None or claim[0] is not threading.current_thread():
+                return
+            del self.in_flight[stripe][token]
+        # the waiters will find no result and try for themselves
+        claim[1].set()
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def clear(self):
+        for stripe, results in enumerate(self.results):
+            with self.locks[stripe]:
+                results.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Tabulation(object):
+    """the results of a function decorated with execute_iteratively(domain=...)
+    held in a table with a cell for every combination of integer args in the
+    domain, for one thread.  The domain gives a (low, high) range for each
+    positional arg, high excluded.
+
+    Cells are filled bottom up, in row major order, by calling the original
+    function once per cell, as far as the cell asked for.  Calls it makes to
+    cells already filled are answered straight from the table, without
+    tokens, hashing or a stack.  Calls to cells not filled yet, and calls
+    from outside the domain, are left to the ExecutionStack as usual.
+
+    Without 'dtype', the cells are kept in a list.  With one, they're kept in
+    an array.array of that typecode, which is more compact but only holds
+    numbers of that type.
+
+    A 'vectorized' recurrence computes a whole row at a time in place of
+    calling the function once per cell.  It is called with the table and the
+    value of the first arg for the row, and returns the row, the rows before
+    it having been filled already.  Row i of the table is table[i - low].
+    With NumPy installed, the table is an ndarray of the domain's shape, of
+    'dtype' if given.  Without it, the table is a list of the rows returned
+    so far."""
+
+    def __init__(self, body, domain, dtype=None, vectorized=None):
+        self.body = body
+        self.lows = tuple(low for low, high in domain)
+        self.shape = tuple(high - low for low, high in domain)
+        self.strides = []
+        size = 1
+        for length in reversed(self.shape):
+            self.strides.insert(0, size)
+            size *= length
+        self.strides = tuple(self.strides)
+        self.vectorized = vectorized
+        if vectorized is not None and numpy is not None:
+            self.table = numpy.empty(
+                self.shape,
+                dtype=object if dtype is None else dtype
+            )
+            self.cells = self.table.reshape(-1)
+            # a plain Python value rather than a NumPy scalar
+            self.get = self.cells.item
+        else:
+            self.table = []
+            if dtype is None:
+                self.cells = [None] * size
+            else:
+                self.cells = array.array(dtype, [0]) * size
+            self.get = self.cells.__getitem__
+        # every cell before this one, in row major order, has its result
+        self.filled = 0
+        self.filling = False
+
+    def flat_index(self, args, kwargs):
+        """return the position of the cell for a call, or None if the call
+        is outside the domain"""
+        if kwargs or len(args) != len(self.lows):
+            return None
+        flat = 0
+        for value, low, length, stride in zip(args, self.lows, self.shape, self.strides):
+            if not isinstance(value, integer_types) or not low <= value < low + length:
+                return None
+            flat += (value - low) * stride
+        return flat
+
+    def args_for(self, flat):
+        args = []
+        for low, stride in zip(self.lows, self.strides):
+            offset, flat = divmod(flat, stride)
+            args.append(low + offset)
+        return args
+
+    def evaluate(self, flat):
+        """fill the table as far as the cell at 'flat' and return its result.
+        The cells are computed as calls in their own right, not as part of
+        whichever evaluation asked for them."""
+        previous_evaluation = ExecutionStack.current()
+        ExecutionStack.local_storage.current = None
+        self.filling = True
+        try:
+            if self.vectorized is None:
+                self.fill_cells(flat)
+            else:
+                self.fill_rows(flat)
+        finally:
+            self.filling = False
+            ExecutionStack.local_storage.current = previous_evaluation
+        return self.get(flat)
+
+    def fill_cells(self, target):
+        cells = self.cells
+        body = self.body
+        while self.filled <= target:
+            cells[self.filled] = body(*self.args_for(self.filled))
+            self.filled += 1
+
+    def fill_rows(self, target):
+        row_size = self.strides[0]
+        while self.filled <= target:
+            row = self.filled // row_size
+            values = self.vectorized(self.table, self.lows[0] + row)
+            if numpy is not None:
+                self.table[row] = values
+            else:
+                self.table.append(values)
+                if len(self.shape) == 1:
+                    self.cells[row] = values
+                else:
+                    self.cells[self.filled:self.filled + row_size] = (
+                        values if isinstance(self.cells, list)
+                        else array.array(self.cells.typecode, values)
+                    )
+            self.filled += row_size
+
+
+def stable_key(static_value):
+    """render the frozen form of an argument as text that is the same in
+    every process, unlike hash() or the iteration order of a frozenset.
+    Values other than tuples and frozensets are rendered with repr, so they
+    must have one that doesn't vary from process to process."""
+    if isinstance(static_value, tuple):
+        return '(%s)' % ','.join(stable_key(x) for x in static_value)
+    if isinstance(static_value, frozenset):
+        return '{%s}' % ','.join(sorted(stable_key(x) for x in static_value))
+    return '%s:%r' % (type(static_value).__name__, static_value)
+
+
+class SqliteStore(object):
+    """a persistent memo kept in an SQLite database file, so that results
+    outlive the process that computed them.  Other processes, or the same
+    one after a restart, using the same file start warm.
+
+    Lookups read through to the database whenever the in memory memo
+    misses.  New results are written back in batches of 'batch_size', and
+    whatever is left over is written when the evaluation finishes.  With
+    'max_entries', the oldest rows are deleted to keep the file to size.
+
+    Keys are a digest of the function's module and name together with
+    stable_key of the redemption token's static args and kwargs.  Results
+    must be picklable.  Each thread uses its own connection."""
+
+    def __init__(self, path, max_entries=None, batch_size=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.local_storage = threading.local()
+        connection = self.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS results '
+            '(key TEXT PRIMARY KEY, result BLOB)'
+        )
+        connection.commit()
+
+    def connection(self):
         try:
-            return self.hash_value
+            return self.local_storage.connection
         except AttributeError:
-            self.hash_value = (self.static_args, self.static_kwargs).__hash__()
-            return self.hash_value
+            self.local_storage.connection = sqlite3.connect(self.path)
+            self.local_storage.pending_writes = {}
+            return self.local_storage.connection
 
-    def __eq__(self, other):
-        return self.static_args == other.static_args and self.static_kwargs == other.static_kwargs
+    @staticmethod
+    def key(fn, token):
+        return hashlib.sha1((
+            '%s.%s%s' % (
+                fn.__module__,
+                fn.__name__,
+                stable_key((token.static_args, token.static_kwargs))
+            )
+        ).encode('utf-8')).hexdigest()
+
+    def get(self, fn, token):
+        """return the stored result for fn called with the args of 'token',
+        raising KeyError if there isn't one"""
+        key = self.key(fn, token)
+        connection = self.connection()
+        try:
+            return self.local_storage.pending_writes[key]
+        except KeyError:
+            pass
+        row = connection.execute(
+            'SELECT result FROM results WHERE key = ?',
+            (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(token)
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, fn, token, result):
+        self.connection()
+        pending_writes = self.local_storage.pending_writes
+        pending_writes[self.key(fn, token)] = result
+        if len(pending_writes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """write the calling thread's pending results to the database"""
+        connection = self.connection()
+        pending_writes = self.local_storage.pending_writes
+        if not pending_writes:
+            return
+        connection.executemany(
+            'INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)',
+            [
+                (key, sqlite3.Binary(pickle.dumps(result, 2)))
+                for key, result in pending_writes.items()
+            ]
+        )
+        pending_writes.clear()
+        if self.max_entries is not None:
+            # replaced rows get new rowids, so the lowest are the stalest
+            connection.execute(
+                'DELETE FROM results WHERE rowid IN ('
+                'SELECT rowid FROM results ORDER BY rowid LIMIT max(0, '
+                '(SELECT count(*) FROM results) - ?))',
+                (self.max_entries,)
+            )
+        connection.commit()
+
+    def __len__(self):
+        self.flush()
+        return self.connection().execute(
+            'SELECT count(*) FROM results'
+        ).fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.connection().close()
+        del self.local_storage.connection
+
+
+def copy_function(fn):
+    """return a new function running the code of 'fn', with its globals,
+    defaults and closure, for the state of one decoration to be kept on.
+    'fn' itself is left alone, so decorating it again starts afresh rather
+    than reconfiguring the wrapper made before."""
+    if not isinstance(fn, types.FunctionType):
+        # some other callable: a function forwarding to it will do
+        return lambda *args, **kwargs: fn(*args, **kwargs)
+    the_copy = types.FunctionType(
+        fn.__code__,
+        fn.__globals__,
+        fn.__name__,
+        fn.__defaults__,
+        fn.__closure__
+    )
+    if getattr(fn, '__kwdefaults__', None):
+        the_copy.__kwdefaults__ = dict(fn.__kwdefaults__)
+    return update_wrapper(the_copy, fn)
+
+
+def get_tabulation(fn):
+    """return the calling thread's Tabulation for a decorated function"""
+    try:
+        return fn.local_storage.tabulation
+    except AttributeError:
+        fn.local_storage.tabulation = fn.make_tabulation()
+        return fn.local_storage.tabulation
+
+
+def get_result_cache(fn):
+    """return the calling thread's memo of results for the
+    'defining_function' of a decorated function"""
+    try:
+        return fn.local_storage.result_cache
+    except AttributeError:
+        fn.local_storage.result_cache = fn.make_result_cache()
+        return fn.local_storage.result_cache
+
+
+ExecutionStats = namedtuple(
+    'ExecutionStats',
+    'executions replays hits misses unknowns max_depth seconds'
+)
+
+
+class ExecutionCounters(object):
+    """the running counts behind ExecutionStats for one decorated function
+    within one thread"""
+    __slots__ = (
+        'executions',
+        'replays',
+        'hits',
+        'misses',
+        'unknowns',
+        'max_depth',
+        'seconds'
+    )
+
+    def __init__(self):
+        self.executions = 0
+        self.replays = 0
+        self.hits = 0
+        self.misses = 0
+        self.unknowns = 0
+        self.max_depth = 0
+        self.seconds = 0.0
+
+
+class Instrumentation(object):
+    """the statistics and hooks of a function decorated by
+    execute_iteratively with stats=True or with any of the hooks.  Without
+    them the function has none at all, and the evaluation loop only checks
+    for its absence.
+
+    Counts are kept for each thread, as the memo is:
+
+        executions  bodies executed, replays included
+        replays     executions of a body that had already been executed for
+                    the same arguments, but ran into unknown values
+        hits        calls answered by the memo
+        misses      calls the memo couldn't answer
+        unknowns    calls trapped while a body was executing
+        max_depth   the deepest the stack has been when this function's
+                    unknowns were pushed onto it
+        seconds     time spent executing bodies
+
+    Each hook is called with the decorated function, then the args and
+    kwargs of the call concerned:
+
+        on_push       a call's unknown is pushed onto the stack, as a
+                      dependency of the body that was executing
+        on_pop        a call's unknown is taken off the stack to be resolved
+        on_cache_hit  a call is answered by the memo
+        on_result     a call's result is computed, given as a fourth argument
+
+    With a 'profile', a DependencyProfile, the executions of the
+    function's bodies and the unknowns they wait on are recorded in it too.
+    """
+
+    def __init__(
+        self,
+        wrapped_fn,
+        on_push=None,
+        on_pop=None,
+        on_cache_hit=None,
+        on_result=None,
+        profile=None
+    ):
+        self.wrapped_fn = wrapped_fn
+        self.on_push = on_push
+        self.on_pop = on_pop
+        self.on_cache_hit = on_cache_hit
+        self.on_result = on_result
+        self.profile = profile
+        self.local_storage = threading.local()
+
+    def counters(self):
+        """return the calling thread's ExecutionCounters"""
+        try:
+            return self.local_storage.counters
+        except AttributeError:
+            self.local_storage.counters = ExecutionCounters()
+            return self.local_storage.counters
+
+    def stats(self):
+        counters = self.counters()
+        return ExecutionStats(
+            counters.executions,
+            counters.replays,
+            counters.hits,
+            counters.misses,
+            counters.unknowns,
+            counters.max_depth,
+            counters.seconds
+        )
+
+    def clear(self):
+        self.local_storage.counters = ExecutionCounters()
+
+
+def describe_call(name, args, kwargs, limit=None):
+    """return a call written out as source, like 'fib(10)', cut short at
+    'limit' characters"""
+    arguments = [repr(an_arg) for an_arg in args]
+    arguments.extend(
+        '%s=%r' % (a_name, kwargs[a_name]) for a_name in sorted(kwargs)
+    )
+    description = '%s(%s)' % (name, ', '.join(arguments))
+    if limit is not None and len(description) > limit:
+        description = description[:limit - 3] + '...'
+    return description
+
+
+class ProfileNode(object):
+    """a call recorded by a DependencyProfile: how many times its body was
+    executed, how many of those were replays, the seconds spent in them
+    all, and the calls it waited on, in the order it first asked for
+    them."""
+    __slots__ = (
+        'defining_function',
+        'redemption_token',
+        'executions',
+        'replays',
+        'seconds',
+        'dependencies'
+    )
+
+    def __init__(self, defining_function, redemption_token):
+        self.defining_function = defining_function
+        self.redemption_token = redemption_token
+        self.executions = 0
+        self.replays = 0
+        self.seconds = 0.0
+        self.dependencies = OrderedDict()
+
+    @property
+    def key(self):
+        return (self.defining_function, self.redemption_token)
+
+    def describe(self, limit=None):
+        args, kwargs = self.redemption_token
+        return describe_call(
+            self.defining_function.__name__,
+            args,
+            kwargs,
+            limit
+        )
+
+    def __repr__(self):
+        return '<ProfileNode %s executions=%d replays=%d seconds=%.6f>' % (
+            self.describe(60),
+            self.executions,
+            self.replays,
+            self.seconds
+        )
+
+
+class DependencyProfile(object):
+    """the dependency graph of evaluations of the functions decorated with
+    execute_iteratively(profile=...) given this profile.  Several functions
+    can share one, so that calls between them are seen as well:
+
+        profile = DependencyProfile()
+
+        @execute_iteratively(profile=profile)
+        def fib(n):
+            ...
+
+        fib(30)
+        print(profile.summary(10))
+        open('fib.dot', 'w').write(profile.to_dot())
+
+    Nodes are calls, a defining function and redemption token each, and an
+    edge goes from a call to each unknown its body waited on.  Each node
+    counts the executions of its body, how many of those were replays, and
+    the seconds spent in them.  Calls answered by the memo were never
+    waited on, so they appear only where they were first computed.  The
+    graph grows with every evaluation until 'clear' is called, and is
+    shared by all threads."""
+
+    orderings = ('executions', 'replays', 'seconds')
+
+    def __init__(self):
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node(self, defining_function, redemption_token):
+        """return the node of a call, added if it is new.  The lock must be
+        held."""
+        key = (defining_function, redemption_token)
+        try:
+            return self.nodes[key]
+        except KeyError:
+            a_node = self.nodes[key] = ProfileNode(
+                defining_function,
+                redemption_token
+            )
+            return a_node
+
+    def record_execution(self, defining_function, redemption_token, replay, seconds):
+        with self.lock:
+            a_node = self.node(defining_function, redemption_token)
+            a_node.executions += 1
+            if replay:
+                a_node.replays += 1
+            a_node.seconds += seconds
+
+    def record_waits(self, defining_function, redemption_token, unknowns):
+        """add an edge from a call to each of the unknowns its body ran
+        into"""
+        with self.lock:
+            dependencies = self.node(
+                defining_function,
+                redemption_token
+            ).dependencies
+            for an_unknown in unknowns:
+                key = (an_unknown.defining_function, an_unknown.redemption_token)
+                self.node(*key)
+                dependencies[key] = None
+
+    def top(self, n=10, by='replays'):
+        """return the 'n' nodes with the most 'executions' or 'replays', or
+        the most time spent in 'seconds'"""
+        if by not in self.orderings:
+            raise ValueError(
+                'by must be one of %s, not %r' % (self.orderings, by)
+            )
+        with self.lock:
+            nodes = list(self.nodes.values())
+        nodes.sort(key=lambda a_node: getattr(a_node, by), reverse=True)
+        return nodes[:n]
+
+    def critical_path(self):
+        """return the chain of nodes, from a call nothing waited on down
+        through one dependency at a time, that spent the most seconds in
+        total: the part of the work that no amount of memoizing the rest
+        would save"""
+        with self.lock:
+            nodes = list(self.nodes.values())
+        # the seconds of the costliest chain starting at each node, and the
+        # key of the next node along it.  Worked out without recursion, as
+        # the graph can be as deep as the recursion was.
+        chains = {}
+        waited_on = set()
+        for a_node in nodes:
+            waited_on.update(a_node.dependencies)
+        visiting = set()
+        for a_node in nodes:
+            stack = [(a_node, False)]
+            while stack:
+                top_node, expanded = stack.pop()
+                if top_node.key in chains:
+                    continue
+                if not expanded:
+                    if top_node.key in visiting:
+                        continue
+                    visiting.add(top_node.key)
+                    stack.append((top_node, True))
+                    for key in top_node.dependencies:
+                        # a cycle, were there one, is cut where it closes
+                        if key not in chains and key not in visiting:
+                            stack.append((self.nodes[key], False))
+                    continue
+                visiting.discard(top_node.key)
+                best_seconds, best_key = 0.0, None
+                for key in top_node.dependencies:
+                    if key in chains and chains[key][0] > best_seconds:
+                        best_seconds, best_key = chains[key][0], key
+                chains[top_node.key] = (top_node.seconds + best_seconds, best_key)
+        roots = [
+            a_node for a_node in nodes if a_node.key not in waited_on
+        ] or nodes
+        if not roots:
+            return []
+        key = max(roots, key=lambda a_node: chains[a_node.key][0]).key
+        path = []
+        while key is not None:
+            path.append(self.nodes[key])
+            key = chains[key][1]
+        return path
+
+    def as_dict(self):
+        """return the graph as plain lists and dicts, ready for json"""
+        with self.lock:
+            nodes = list(self.nodes.values())
+        ids = dict((a_node.key, index) for index, a_node in enumerate(nodes))
+        return {
+            'nodes': [
+                {
+                    'id': ids[a_node.key],
+                    'function': a_node.defining_function.__name__,
+                    'call': a_node.describe(),
+                    'executions': a_node.executions,
+                    'replays': a_node.replays,
+                    'seconds': a_node.seconds,
+                }
+                for a_node in nodes
+            ],
+            'edges': [
+                [ids[a_node.key], ids[key]]
+                for a_node in nodes
+                for key in a_node.dependencies
+            ],
+            'critical_path': [
+                ids[a_node.key] for a_node in self.critical_path()
+            ],
+        }
+
+    def to_json(self, **kwargs):
+        """return the graph as JSON.  kwargs, such as indent, go to
+        json.dumps."""
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def to_dot(self, limit=60):
+        """return the graph in the Graphviz dot language, each call cut
+        short at 'limit' characters.  Nodes on the critical path are
+        drawn bold."""
+        with self.lock:
+            nodes = list(self.nodes.values())
+        critical = set(a_node.key for a_node in self.critical_path())
+        ids = dict((a_node.key, index) for index, a_node in enumerate(nodes))
+        lines = ['digraph reitercurse {', '    node [shape=box];']
+        for a_node in nodes:
+            label = '%s\\nexecutions %d, replays %d, %.6fs' % (
+                a_node.describe(limit).replace('\\', '\\\\').replace('"', '\\"'),
+                a_node.executions,
+                a_node.replays,
+                a_node.seconds
+            )
+            lines.append('    n%d [label="%s"%s];' % (
+                ids[a_node.key],
+                label,
+                ', style=bold' if a_node.key in critical else ''
+            ))
+        for a_node in nodes:
+            for key in a_node.dependencies:
+                lines.append('    n%d -> n%d;' % (ids[a_node.key], ids[key]))
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, n=10):
+        """return a table of the 'n' most replayed and the 'n' most
+        expensive calls"""
+        lines = []
+        for title, by in (('most replayed', 'replays'), ('most expensive', 'seconds')):
+            lines.append('%s:' % title)
+            lines.append('    %10s %10s %12s  %s' % ('executions', 'replays', 'seconds', 'call'))
+            for a_node in self.top(n, by):
+                lines.append('    %10d %10d %12.6f  %s' % (
+                    a_node.executions,
+                    a_node.replays,
+                    a_node.seconds,
+                    a_node.describe(60)
+                ))
+        return '\n'.join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.nodes.clear()
+
+
+class FrameStack(object):
+    """the stack of unknowns of an ExecutionStack.  Rather than an
+    UnknownValue per frame, it holds the index of the defining function in
+    a table of the functions seen, in an array, and the redemption token in
+    a list.  UnknownValues are made afresh as frames are popped.  Tokens are
+    kept as they are: their args have to be kept somewhere anyway, and a
+    table of ids for them would only add an entry per frame.
+
+    With a 'spill_threshold', frames beyond that many are not kept in memory
+    at all.  Whenever 'trim' finds the stack has outgrown the threshold, the
+    oldest half of the frames held in memory are pickled to a temporary file
+    in 'spill_directory', together with whatever 'on_spill' gives for them.
+    Once the frames above them have all been popped, they are read back,
+    'on_restore' being given the same for each.  The top of the stack, where
+    the work is, stays in memory.  Tokens, and so args, must be picklable
+    for that, as must whatever 'on_spill' gives.
+
+    Iterating gives the frames in memory, bottom first."""
+
+    def __init__(
+        self,
+        unknowns=(),
+        spill_threshold=None,
+        spill_directory=None,
+        on_spill=None,
+        on_restore=None
+    ):
+        self.functions = []
+        self.function_indexes = {}
+        self.function_index_stack = array.array('l')
+        self.redemption_token_stack = []
+        self.spill_threshold = spill_threshold
+        self.spill_directory = spill_directory
+        self.on_spill = on_spill
+        self.on_restore = on_restore
+        self.spill_file = None
+        # the offset and length of each chunk of frames in the spill file,
+        # the newest last
+        self.spilled_chunks = []
+        self.spilled_frames = 0
+        for an_unknown in unknowns:
+            self.append(an_unknown)
+
+    def __len__(self):
+        return len(self.redemption_token_stack) + self.spilled_frames
+
+    def __bool__(self):
+        return bool(self.redemption_token_stack) or bool(self.spilled_chunks)
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        for index, redemption_token in zip(self.function_index_stack, self.redemption_token_stack):
+            yield UnknownValue(self.functions[index], redemption_token)
+
+    def append(self, unknown):
+        defining_function = unknown.defining_function
+        try:
+            index = self.function_indexes[defining_function]
+        except KeyError:
+            index = self.function_indexes[defining_function] = len(self.functions)
+            self.functions.append(defining_function)
+        self.function_index_stack.append(index)
+        self.redemption_token_stack.append(unknown.redemption_token)
+
+    def pop(self):
+        if not self.redemption_token_stack and self.spilled_chunks:
+            self.restore()
+        return UnknownValue(
+            self.functions[self.function_index_stack.pop()],
+            self.redemption_token_stack.pop()
+        )
+
+    def top(self, count):
+        """return the top 'count' frames, bottom first"""
+        return [
+            UnknownValue(self.functions[index], redemption_token)
+            for index, redemption_token in zip(
+                self.function_index_stack[-count:],
+                self.redemption_token_stack[-count:]
+            )
+        ]
+
+    def trim(self):
+        """spill to disk if there are more than 'spill_threshold' frames in
+        memory.  It is up to the owner to call this when the frames are in a
+        state to be spilled, not in the middle of pushing a batch of them."""
+        if self.spill_threshold is not None and len(self.redemption_token_stack) > self.spill_threshold:
+            self.spill()
+
+    def clear(self):
+        del self.function_index_stack[:]
+        del self.redemption_token_stack[:]
+        del self.spilled_chunks[:]
+        self.spilled_frames = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def spill(self):
+        count = len(self.redemption_token_stack) // 2
+        indexes = self.function_index_stack[:count]
+        redemption_tokens = self.redemption_token_stack[:count]
+        if self.on_spill is None:
+            extras = [None] * count
+        else:
+            extras = self.on_spill([
+                (self.functions[index], redemption_token)
+                for index, redemption_token in zip(indexes, redemption_tokens)
+            ])
+        chunk = list(zip(indexes, redemption_tokens, extras))
+        del self.function_index_stack[:count]
+        del self.redemption_token_stack[:count]
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_directory)
+        data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+        offset = self.spilled_chunks[-1][0] + self.spilled_chunks[-1][1] if self.spilled_chunks else 0
+        self.spill_file.seek(offset)
+        self.spill_file.write(data)
+        self.spilled_chunks.append((offset, len(data)))
+        self.spilled_frames += count
+
+    def restore(self):
+        offset, length = self.spilled_chunks.pop()
+        self.spill_file.seek(offset)
+        chunk = pickle.loads(self.spill_file.read(length))
+        self.spill_file.truncate(offset)
+        self.spilled_frames -= len(chunk)
+        for index, redemption_token, extra in chunk:
+            self.function_index_stack.append(index)
+            self.redemption_token_stack.append(redemption_token)
+            if self.on_restore is not None:
+                self.on_restore(self.functions[index], redemption_token, extra)
 
 
 class ExecutionStack(object):
+    """the explicit stack of unknowns for one evaluation of a function
+    decorated by execute_iteratively.  Each evaluation has its own, so that
+    several can be under way at once on one thread, as coroutines driven by
+    an event loop would have them.  While an evaluation is running, it is
+    the thread's current one, and the trap reports to it."""
     local_storage = threading.local()
 
+    def __init__(self, *unknowns):
+        spill = unknowns[0].defining_function.spill if unknowns else None
+        if spill is None:
+            self.execution_stack = FrameStack(unknowns)
+        else:
+            self.execution_stack = FrameStack(
+                unknowns,
+                spill_threshold=spill[0],
+                spill_directory=spill[1],
+                on_spill=self.spill_frames,
+                on_restore=self.restore_frame
+            )
+        # every call the body being executed attempts to make that can't be
+        # answered from a cache is recorded here by the trap
+        self.discovered_unknowns = []
+        # the dependencies each waiting frame has discovered so far, keyed by
+        # (defining_function, redemption_token).  They stay pinned in their
+        # result caches until the waiting frame has its own result.
+        self.pinned_dependencies = {}
+        # dependencies of frames spilled to disk that are still to be
+        # computed by frames in memory: how many spilled frames want each
+        self.wanted_by_spilled = {}
+        # those since computed, pinned on behalf of the spilled frames until
+        # they are read back: how many pins each
+        self.pinned_for_spilled = {}
+        # persistent stores with results waiting to be written back
+        self.stores_to_flush = set()
+        # sub-problems being computed by parallel workers, keyed by
+        # (defining_function, redemption_token)
+        self.futures = {}
+        self.done = False
+        self.result = None
+
+    @classmethod
+    def current(kls):
+        """return the evaluation running on the calling thread, if any"""
+        return getattr(kls.local_storage, 'current', None)
+
     @classmethod
     def is_in_use(kls):
-        try:
-            return kls.local_storage.in_use
-        except AttributeError:
-            kls.local_storage.in_use = False
-            return False
+        return getattr(kls.local_storage, 'current', None) is not None
 
     @classmethod
-    def get_execution_stack(kls):
-        try:
-            return kls.local_storage.execution_stack
-        except AttributeError, x:
-            kls.local_storage.execution_stack = []
-            return kls.local_storage.execution_stack
+    def discover(kls, unknown):
+        """record an unknown created by the trap while a body is executing"""
+        kls.local_storage.current.discovered_unknowns.append(unknown)
 
     @classmethod
-    def execute(kls):
-        kls.local_storage.in_use = True
+    def execute(kls, *unknowns):
+        """evaluate to completion and return the result of the last unknown
+        to be resolved"""
+        evaluation = kls(*unknowns)
+        evaluation.run()
+        return evaluation.result
+
+    def run(self, max_steps=None, deadline=None):
+        """resolve unknowns until none are left, until 'max_steps' bodies
+        have been executed, or until time.time() passes 'deadline'.  Return
+        True once the evaluation is done, its result in 'result'."""
+        previous_evaluation = self.current()
+        self.local_storage.current = self
+        execution_stack = self.execution_stack
+        pinned_dependencies = self.pinned_dependencies
+        futures = self.futures
+        wanted_by_spilled = self.wanted_by_spilled
+        steps = 0
+        the_top_unknown = None
         try:
-            execution_stack = kls.get_execution_stack()
             while execution_stack:
+                if steps == max_steps:
+                    return False
+                if deadline is not None and time.time() > deadline:
+                    return False
                 the_top_unknown = execution_stack.pop()
                 the_top_redemption_token = the_top_unknown.redemption_token
+                the_top_result_cache = get_result_cache(
+                    the_top_unknown.defining_function
+                )
+                the_top_instrumentation = the_top_unknown.defining_function.instrumentation
+                if the_top_instrumentation is not None and the_top_instrumentation.on_pop is not None:
+                    the_top_instrumentation.on_pop(
+                        the_top_instrumentation.wrapped_fn,
+                        *the_top_redemption_token
+                    )
 
                 try:
-                    result_for_top_unknown = the_top_unknown.defining_function.local_storage.result_cache[the_top_redemption_token]
+                    result_for_top_unknown = the_top_result_cache[the_top_redemption_token]
                 except KeyError:
+                    computed_elsewhere = the_top_result_cache.claim(
+                        the_top_redemption_token
+                    )
+                    if computed_elsewhere is not None:
+                        # another thread is computing this very result. Wait
+                        # for it, then look again.
+                        computed_elsewhere.wait()
+                        execution_stack.append(the_top_unknown)
+                        continue
+                    steps += 1
                     next_args, next_kwargs = the_top_redemption_token
-                    # this is a pivotal function invocation.
-                    # "the_top_unknown.defining_function" is a reference to
-                    # the original function that was wrapped by the decorator.
-                    # However, when this function manages to call itself in an
-                    # attempt to recurse, it doesn't have a reference to itself,
-                    # it has a reference to the wrapper function: "hijacked_fn"
-                    result_for_top_unknown = the_top_unknown.defining_function(*next_args, **next_kwargs)
-
-                    if isinstance(result_for_top_unknown, UnknownValue):
-                        # the result for the top unknown was another unknown
+                    discovered_unknowns = self.discovered_unknowns = []
+                    the_top_future = futures.pop(
+                        (the_top_unknown.defining_function, the_top_redemption_token),
+                        None
+                    ) if futures else None
+                    if the_top_future is not None:
+                        # this sub-problem was sent off to a worker, which
+                        # sends back what it found on the way as well
+                        result_for_top_unknown, worker_results = the_top_future.result()
+                        for a_redemption_token, a_result in worker_results:
+                            the_top_result_cache[a_redemption_token] = a_result
+                    elif the_top_instrumentation is not None:
+                        result_for_top_unknown = self.execute_instrumented(
+                            the_top_unknown,
+                            the_top_instrumentation
+                        )
+                    else:
+                        # this is a pivotal function invocation.
+                        # "the_top_unknown.defining_function" is a reference to
+                        # the original function that was wrapped by the decorator.
+                        # However, when this function manages to call itself in an
+                        # attempt to recurse, it doesn't have a reference to itself,
+                        # it has a reference to the wrapper function: "hijacked_fn"
+                        result_for_top_unknown = the_top_unknown.defining_function(*next_args, **next_kwargs)
+
+                    if not discovered_unknowns and isinstance(result_for_top_unknown, UnknownValue):
+                        # an unknown that came from somewhere other than
+                        # the trap still has to be resolved first
+                        discovered_unknowns.append(result_for_top_unknown)
+
+                    if discovered_unknowns:
+                        # the body tried to use values that are not yet
+                        # known, so whatever it returned is meaningless.
                         # push the top unknown back onto the stack
                         execution_stack.append(the_top_unknown)
-                        # the quest for a new value for the top unknown
-                        # resulted in the creation of a new unknown. Push it
-                        # onto the execution_stack
-                        execution_stack.append(result_for_top_unknown)
-##                        print "PUSH", execution_stack
+                        # then push every distinct unknown the body ran into,
+                        # so that they are all resolved before the body is
+                        # replayed.  They're pushed in reverse so that they
+                        # are resolved in the order the body asked for them.
+                        the_top_dependencies = pinned_dependencies.setdefault(
+                            (the_top_unknown.defining_function, the_top_redemption_token),
+                            []
+                        )
+                        already_pushed = set()
+                        for an_unknown in reversed(discovered_unknowns):
+                            key = (
+                                an_unknown.defining_function,
+                                an_unknown.redemption_token
+                            )
+                            if key not in already_pushed:
+                                already_pushed.add(key)
+                                execution_stack.append(an_unknown)
+                                get_result_cache(key[0]).pin(key[1])
+                                the_top_dependencies.append(key)
+                                an_instrumentation = key[0].instrumentation
+                                if an_instrumentation is not None:
+                                    counters = an_instrumentation.counters()
+                                    if len(execution_stack) > counters.max_depth:
+                                        counters.max_depth = len(execution_stack)
+                                    if an_instrumentation.on_push is not None:
+                                        an_instrumentation.on_push(
+                                            an_instrumentation.wrapped_fn,
+                                            *key[1]
+                                        )
+                        if the_top_instrumentation is not None and the_top_instrumentation.profile is not None:
+                            the_top_instrumentation.profile.record_waits(
+                                the_top_unknown.defining_function,
+                                the_top_redemption_token,
+                                discovered_unknowns
+                            )
+                        if len(already_pushed) > 1:
+                            self.dispatch(execution_stack.top(len(already_pushed)))
+                        execution_stack.trim()
+                        continue
                     else:
                         # constant case
-                        the_top_unknown.defining_function.local_storage.result_cache[the_top_redemption_token] = result_for_top_unknown
-##                        print "POP ", execution_stack
-            return result_for_top_unknown
+                        the_top_result_cache[the_top_redemption_token] = result_for_top_unknown
+                        the_top_store = the_top_unknown.defining_function.store
+                        if the_top_store is not None:
+                            the_top_store.put(
+                                the_top_unknown.defining_function,
+                                the_top_redemption_token,
+                                result_for_top_unknown
+                            )
+                            self.stores_to_flush.add(the_top_store)
+                        self.release(
+                            pinned_dependencies.pop(
+                                (the_top_unknown.defining_function, the_top_redemption_token),
+                                ()
+                            )
+                        )
+                        if the_top_instrumentation is not None and the_top_instrumentation.on_result is not None:
+                            next_args, next_kwargs = the_top_redemption_token
+                            the_top_instrumentation.on_result(
+                                the_top_instrumentation.wrapped_fn,
+                                next_args,
+                                next_kwargs,
+                                result_for_top_unknown
+                            )
+                if wanted_by_spilled:
+                    the_top_key = (the_top_unknown.defining_function, the_top_redemption_token)
+                    if the_top_key in wanted_by_spilled:
+                        self.pin_for_spilled(the_top_key, result_for_top_unknown)
+                self.result = result_for_top_unknown
+            self.done = True
+            self.finish()
+            return True
+        except BaseException:
+            if the_top_unknown is not None:
+                execution_stack.append(the_top_unknown)
+            self.abandon()
+            raise
+        finally:
+            self.local_storage.current = previous_evaluation
+
+    def execute_instrumented(self, the_top_unknown, instrumentation):
+        """execute the body of the_top_unknown's function, counting and
+        timing it for its Instrumentation"""
+        counters = instrumentation.counters()
+        counters.executions += 1
+        replay = (
+            the_top_unknown.defining_function,
+            the_top_unknown.redemption_token
+        ) in self.pinned_dependencies
+        if replay:
+            # it discovered unknowns the last time it was executed
+            counters.replays += 1
+        next_args, next_kwargs = the_top_unknown.redemption_token
+        began = default_timer()
+        try:
+            return the_top_unknown.defining_function(*next_args, **next_kwargs)
+        finally:
+            seconds = default_timer() - began
+            counters.seconds += seconds
+            if instrumentation.profile is not None:
+                instrumentation.profile.record_execution(
+                    the_top_unknown.defining_function,
+                    the_top_unknown.redemption_token,
+                    replay,
+                    seconds
+                )
+
+    def suspend(self):
+        """put the unfinished evaluation in a state to be run again later,
+        perhaps by another thread: frames waiting to be replayed are no
+        longer claimed by this thread, and the stores are written back"""
+        for an_unknown in self.execution_stack:
+            get_result_cache(an_unknown.defining_function).abandon(
+                an_unknown.redemption_token
+            )
+        for a_store in self.stores_to_flush:
+            a_store.flush()
+        self.stores_to_flush.clear()
+
+    def abandon(self):
+        """give up on the evaluation, letting other threads waiting on the
+        unfinished frames get on with computing them themselves"""
+        for an_unknown in self.execution_stack:
+            get_result_cache(an_unknown.defining_function).abandon(
+                an_unknown.redemption_token
+            )
+        self.finish()
+
+    def spill_frames(self, frames):
+        """what the frames being spilled to disk, bottom first, take with
+        them: the record of the dependencies each has discovered so far.
+        Their pins are let go, so that the result caches hold nothing on
+        behalf of frames that aren't in memory, and a dependency in a cache
+        that may forget it goes to disk with its result if it is known.  One
+        still to be computed by a frame staying in memory is pinned again
+        for the spilled frames once it is.  One still to be computed by a
+        frame spilled along with them is computed after they are read back,
+        or again then if a frame in memory needs it first.  The frames are
+        no longer claimed meanwhile."""
+        # the highest place of each frame in the batch
+        highest = dict((frame, position) for position, frame in enumerate(frames))
+        function_indexes = self.execution_stack.function_indexes
+        records = []
+        released = []
+        for position, (defining_function, redemption_token) in enumerate(frames):
+            get_result_cache(defining_function).abandon(redemption_token)
+            dependencies = self.pinned_dependencies.pop(
+                (defining_function, redemption_token),
+                None
+            )
+            if dependencies is None:
+                records.append(None)
+                continue
+            record = []
+            for key in dependencies:
+                dependency_function, dependency_redemption_token = key
+                dependency_cache = get_result_cache(dependency_function)
+                state = result = None
+                if dependency_cache.may_forget:
+                    try:
+                        result = dependency_cache[dependency_redemption_token]
+                        state = 'known'
+                    except KeyError:
+                        if highest.get(key, -1) < position:
+                            state = 'wanted'
+                            self.wanted_by_spilled[key] = self.wanted_by_spilled.get(key, 0) + 1
+                record.append((
+                    function_indexes[dependency_function],
+                    dependency_redemption_token,
+                    state,
+                    result
+                ))
+            records.append(record)
+            released.extend(dependencies)
+        # only once every result the batch takes along has been read
+        self.release(released)
+        return records
+
+    def restore_frame(self, defining_function, redemption_token, record):
+        """take back the record of a frame read back from disk, pinning its
+        dependencies again"""
+        if record is None:
+            return
+        functions = self.execution_stack.functions
+        dependencies = self.pinned_dependencies[(defining_function, redemption_token)] = []
+        for index, dependency_redemption_token, state, result in record:
+            key = (functions[index], dependency_redemption_token)
+            dependencies.append(key)
+            if state == 'wanted':
+                # computed meanwhile, a pin is already held for the frame;
+                # if not, the frame pins it itself like any other
+                table = self.pinned_for_spilled if key in self.pinned_for_spilled else self.wanted_by_spilled
+                pins = table.pop(key)
+                if pins > 1:
+                    table[key] = pins - 1
+                if table is self.pinned_for_spilled:
+                    continue
+            dependency_cache = get_result_cache(key[0])
+            dependency_cache.pin(dependency_redemption_token)
+            if state == 'known':
+                dependency_cache[dependency_redemption_token] = result
+
+    def pin_for_spilled(self, key, result):
+        """hold on to a result just computed that frames on disk want"""
+        pins = self.wanted_by_spilled.pop(key)
+        result_cache = get_result_cache(key[0])
+        for x in range(pins):
+            result_cache.pin(key[1])
+        # stored again now that it is pinned
+        result_cache[key[1]] = result
+        self.pinned_for_spilled[key] = self.pinned_for_spilled.get(key, 0) + pins
+
+    def finish(self):
+        """let go of everything held on behalf of the unfinished frames and
+        write back whatever the stores are still holding"""
+        for a_future in self.futures.values():
+            a_future.cancel()
+        self.futures.clear()
+        self.execution_stack.clear()
+        for dependencies in self.pinned_dependencies.values():
+            self.release(dependencies)
+        self.pinned_dependencies.clear()
+        self.wanted_by_spilled.clear()
+        for (defining_function, redemption_token), pins in self.pinned_for_spilled.items():
+            self.release([(defining_function, redemption_token)] * pins)
+        self.pinned_for_spilled.clear()
+        for a_store in self.stores_to_flush:
+            a_store.flush()
+        self.stores_to_flush.clear()
+        self.discovered_unknowns = []
+
+    def dispatch(self, sibling_unknowns):
+        """send sibling sub-problems, just discovered together by one body,
+        to the parallel executors of their functions.  Siblings are assumed
+        to be independent of each other.  Those costing less than their
+        function's threshold aren't worth sending and stay on the stack.  So
+        do those costing more than the function's grain: this thread splits
+        them further, so that the pieces sent out are of even size.  If all
+        of the siblings qualify, the one that is next to be resolved stays
+        as well, so this thread has work to do while the workers do theirs.
+        The unknowns stay on the stack either way: when one that was sent
+        out is popped, the result is collected from its future instead of
+        running the body here."""
+        if getattr(self.local_storage, 'in_worker', False):
+            # workers work serially, they don't fan out any further
+            return
+        eligible_unknowns = []
+        for an_unknown in sibling_unknowns:
+            parallel = an_unknown.defining_function.parallel
+            if parallel is None:
+                continue
+            executor, threshold, grain, cost, wrapped_fn = parallel
+            if cost is None:
+                eligible_unknowns.append((an_unknown, executor, wrapped_fn))
+                continue
+            next_args, next_kwargs = an_unknown.redemption_token
+            sibling_cost = cost(*next_args, **next_kwargs)
+            if sibling_cost >= threshold and (grain is None or sibling_cost <= grain):
+                eligible_unknowns.append((an_unknown, executor, wrapped_fn))
+        if len(eligible_unknowns) == len(sibling_unknowns):
+            # the last on the stack is the next to be resolved
+            eligible_unknowns.pop()
+        for an_unknown, executor, wrapped_fn in eligible_unknowns:
+            key = (an_unknown.defining_function, an_unknown.redemption_token)
+            if key not in self.futures:
+                next_args, next_kwargs = an_unknown.redemption_token
+                self.futures[key] = executor.submit(
+                    evaluate_in_worker,
+                    wrapped_fn,
+                    next_args,
+                    next_kwargs
+                )
+
+    @staticmethod
+    def release(dependencies):
+        """unpin the dependencies of a frame that no longer needs them"""
+        for defining_function, redemption_token in dependencies:
+            get_result_cache(defining_function).unpin(redemption_token)
+
+
+def evaluate_in_worker(wrapped_fn, args, kwargs):
+    """run by parallel workers on behalf of ExecutionStack.dispatch.  The
+    decorated function must be importable by the worker, so it has to be
+    defined at the top level of a module when the workers are processes.
+    A worker forked while an evaluation was running on the thread that forked
+    it inherits that evaluation as its current one, so it is set aside.
+
+    Return the result, and the (redemption_token, result) pairs of the memo
+    the worker filled on the way, for the dispatching thread to take into
+    its own.  The worker uses a memo of its own for the purpose, unless the
+    memo is shared, in which case the results are in it already."""
+    local_storage = ExecutionStack.local_storage
+    inherited_evaluation = getattr(local_storage, 'current', None)
+    local_storage.current = None
+    local_storage.in_worker = True
+    fn_local_storage = wrapped_fn.defining_function.local_storage
+    result_cache = wrapped_fn.defining_function.make_result_cache()
+    if isinstance(result_cache, SharedResultCache):
+        result_cache = None
+    else:
+        previous_result_cache = getattr(fn_local_storage, 'result_cache', None)
+        fn_local_storage.result_cache = result_cache
+    try:
+        result = wrapped_fn(*args, **kwargs)
+        if result_cache is None:
+            return result, ()
+        return result, list(result_cache.items())
+    finally:
+        if result_cache is not None:
+            if previous_result_cache is None:
+                del fn_local_storage.result_cache
+            else:
+                fn_local_storage.result_cache = previous_result_cache
+        local_storage.in_worker = False
+        local_storage.current = inherited_evaluation
+
+
+class GeneratorStack(object):
+    """the explicit stack used by execute_as_generator.  Where ExecutionStack
+    replays a function body from the top once the value it was waiting for
+    is known, this stack holds the suspended generators themselves.  When a
+    generator yields a recursive call, it is parked on the stack and a new
+    generator for the call is pushed above it.  When that one produces its
+    result, the parked generator is resumed with the value sent into it.
+    Each body therefore runs exactly once per distinct set of arguments.
+
+    Coroutines from 'async def' functions are driven the same way, their
+    recursive calls awaited rather than yielded.  Whatever else they await
+    is handed on to the event loop by AsyncEvaluation."""
+    local_storage = threading.local()
+
+    def __init__(self, first_unknown):
+        self.frames = []
+        self.pending_unknown = first_unknown
+        self.value_to_send = None
+        self.error_to_throw = None
+        # set when a coroutine awaits something that only an event loop
+        # can deal with (which may be a bare None), until the event loop
+        # resumes the evaluation
+        self.waiting_on_event_loop = False
+        self.awaiting = None
+        self.done = False
+        self.result = None
+
+    @classmethod
+    def is_in_use(kls):
+        return getattr(kls.local_storage, 'current', None) is not None
+
+    @classmethod
+    def execute(kls, first_unknown):
+        evaluation = kls(first_unknown)
+        if not evaluation.run():
+            raise RuntimeError(
+                '%r awaited %r, which needs an event loop: await '
+                'evaluate_async() instead' % (
+                    evaluation.frames[-1][0],
+                    evaluation.awaiting
+                )
+            )
+        return evaluation.result
+
+    def resume(self, value):
+        """carry on after the event loop has dealt with 'awaiting'"""
+        self.waiting_on_event_loop = False
+        self.awaiting = None
+        self.value_to_send = value
+
+    def resume_with_error(self, error):
+        """carry on after 'awaiting' failed, raising the error, an exc_info
+        triple, in the coroutine that awaited it"""
+        self.waiting_on_event_loop = False
+        self.awaiting = None
+        self.value_to_send = None
+        self.error_to_throw = error
+
+    def run(self, max_steps=None):
+        """drive the generators until the first unknown has its result, or
+        until they have been resumed 'max_steps' times, or until a coroutine
+        awaits something that isn't a recursive call.  Return True once the
+        evaluation is done, its result in 'result'."""
+        previous_evaluation = getattr(self.local_storage, 'current', None)
+        self.local_storage.current = self
+        frames = self.frames
+        steps = 0
+        try:
+            while True:
+                if self.pending_unknown is not None:
+                    pending_unknown = self.pending_unknown
+                    self.pending_unknown = None
+                    result_cache = get_result_cache(
+                        pending_unknown.defining_function
+                    )
+                    pending_redemption_token = pending_unknown.redemption_token
+                    try:
+                        self.value_to_send = result_cache[pending_redemption_token]
+                    except KeyError:
+                        next_args, next_kwargs = pending_redemption_token
+                        frames.append((
+                            pending_unknown,
+                            pending_unknown.defining_function(
+                                *next_args,
+                                **next_kwargs
+                            )
+                        ))
+                        self.value_to_send = None
+                    if not frames:
+                        # the very first unknown was already in the cache
+                        self.result = self.value_to_send
+                        self.done = True
+                        return True
+
+                if steps == max_steps or self.waiting_on_event_loop:
+                    return False
+                steps += 1
+                the_top_unknown, the_top_generator = frames[-1]
+                if not hasattr(the_top_generator, 'send'):
+                    # a base case written without 'yield' just returns
+                    result = the_top_generator
+                else:
+                    try:
+                        if self.error_to_throw is None:
+                            yielded = the_top_generator.send(self.value_to_send)
+                        else:
+                            error_to_throw = self.error_to_throw
+                            self.error_to_throw = None
+                            yielded = the_top_generator.throw(*error_to_throw)
+                    except StopIteration as x:
+                        # Python 3 generators and coroutines 'return value'
+                        result = x.args[0] if x.args else None
+                    except BaseException:
+                        # the failure propagates to the parked generator
+                        # below, just as it would with real recursion
+                        frames.pop()
+                        if not frames:
+                            raise
+                        self.error_to_throw = sys.exc_info()
+                        continue
+                    else:
+                        if isinstance(yielded, UnknownValue):
+                            self.pending_unknown = yielded
+                            continue
+                        if is_coroutine(the_top_generator):
+                            # a future, or the like, for the event loop
+                            self.waiting_on_event_loop = True
+                            self.awaiting = yielded
+                            continue
+                        # the first plain value yielded is the result
+                        result = yielded
+                        the_top_generator.close()
+
+                frames.pop()
+                get_result_cache(the_top_unknown.defining_function)[
+                    the_top_unknown.redemption_token
+                ] = result
+                if not frames:
+                    self.result = result
+                    self.done = True
+                    return True
+                self.value_to_send = result
+        finally:
+            self.local_storage.current = previous_evaluation
+
+    def abandon(self):
+        """give up on the evaluation, closing the suspended generators from
+        the top down"""
+        while self.frames:
+            the_top_unknown, the_top_generator = self.frames.pop()
+            if hasattr(the_top_generator, 'close'):
+                the_top_generator.close()
+        self.pending_unknown = None
+        self.waiting_on_event_loop = False
+        self.awaiting = None
+
+
+try:
+    from inspect import iscoroutine as is_coroutine
+    from inspect import iscoroutinefunction as is_coroutine_fn
+except ImportError:
+    # before Python 3.5, there are no coroutines
+    def is_coroutine(x):
+        return False
+    is_coroutine_fn = is_coroutine
+
+
+class AsyncEvaluation(object):
+    """an awaitable that carries out an evaluation in slices of at most
+    'steps_per_slice' body executions, handing control back to the event loop
+    between slices so that one large evaluation doesn't hold it for the
+    duration.  It is written as a plain iterator, as Python 2 can't
+    'return' a value from a generator:
+
+        result = await fact.evaluate_async(100000)
+
+    The evaluation is an ExecutionStack or a GeneratorStack of its own, so
+    any number of them can share a thread.  An error thrown in while a
+    coroutine of the evaluation awaits something of the event loop's, a
+    failed future say, is raised in that coroutine, as it would be without
+    the decorator.  Otherwise, as when the awaiting task is cancelled
+    between slices, the evaluation is abandoned, letting go of the memo
+    entries it pinned and the results it claimed."""
+
+    def __init__(self, evaluation, steps_per_slice=1000):
+        self.evaluation = evaluation
+        self.steps_per_slice = steps_per_slice
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def send(self, value):
+        evaluation = self.evaluation
+        if getattr(evaluation, 'waiting_on_event_loop', False):
+            evaluation.resume(value)
+        return self.run_slice()
+
+    def run_slice(self):
+        evaluation = self.evaluation
+        if evaluation.run(self.steps_per_slice):
+            raise StopIteration(evaluation.result)
+        if getattr(evaluation, 'waiting_on_event_loop', False):
+            # something the evaluation is waiting on
+            return evaluation.awaiting
+        # a bare None lets the event loop attend to others before resuming
+        return None
+
+    def __next__(self):
+        return self.send(None)
+    next = __next__
+
+    def throw(self, exception_type, value=None, traceback=None):
+        """raise what was thrown in where the evaluation awaits the event
+        loop, or else give up on the evaluation and raise it here"""
+        if value is None:
+            value = exception_type() if isinstance(exception_type, type) else exception_type
+        if traceback is not None and hasattr(value, 'with_traceback'):
+            value = value.with_traceback(traceback)
+        evaluation = self.evaluation
+        if getattr(evaluation, 'waiting_on_event_loop', False) and not isinstance(value, GeneratorExit):
+            # should it escape the coroutines, run raises it, with nothing
+            # left on the stack to abandon
+            evaluation.resume_with_error((type(value), value, traceback))
+            return self.run_slice()
+        self.close()
+        raise value
+
+    def close(self):
+        """give up on the evaluation unless it is done already"""
+        if not self.evaluation.done:
+            self.evaluation.abandon()
+
+
+class PendingEvaluation(object):
+    """what fn.evaluate returns in place of a result when the evaluation ran
+    out of steps or time.  It holds the stack of unknowns still to be
+    resolved, while the results found so far stay in the memos, pinned for
+    as long as the stack needs them.  'resume' carries on where it left off,
+    and can be called from any thread:
+
+        outcome = fn.evaluate((n,), max_steps=10000)
+        while isinstance(outcome, PendingEvaluation):
+            outcome = outcome.resume(deadline=time.time() + 0.05)
+
+    While the evaluation is pending, it has the memos of the functions
+    involved to itself: they are taken from the thread that was using them,
+    which starts afresh, and lent to whichever thread resumes it.  So the
+    thread that started the evaluation can go on using the functions while
+    another resumes it, as when the evaluation is spread over the request
+    cycles of a server.  The thread that finishes the evaluation keeps the
+    memos, unless it has memos of its own for those functions by then.
+    Shared memos (shared=True) are safe to use from any thread, so they
+    stay where they are.  'cancel' gives up on the evaluation, unpinning
+    everything it held."""
+
+    def __init__(self, evaluation):
+        self.evaluation = evaluation
+        # the result caches of the functions involved, by function
+        self.result_caches = {}
+
+    @property
+    def done(self):
+        return self.evaluation.done
+
+    def resume(self, max_steps=None, deadline=None):
+        """run until the evaluation is done, until 'max_steps' bodies have
+        been executed, or until time.time() passes 'deadline'.  Return the
+        result once done, or else this PendingEvaluation again."""
+        lent_result_caches = self.lend_result_caches()
+        done = False
+        try:
+            if self.evaluation.run(max_steps, deadline):
+                done = True
+                return self.evaluation.result
+            self.evaluation.suspend()
+            self.keep_result_caches()
+            return self
+        finally:
+            self.return_result_caches(lent_result_caches, adopt=done)
+
+    def cancel(self):
+        """give up on the evaluation"""
+        lent_result_caches = self.lend_result_caches()
+        try:
+            self.evaluation.abandon()
         finally:
-            kls.local_storage.in_use = False
-            kls.local_storage.execution_stack = []
+            self.return_result_caches(lent_result_caches)
+
+    def lend_result_caches(self):
+        """install the kept result caches as the calling thread's, returning
+        what they replaced"""
+        replaced = []
+        for fn, result_cache in self.result_caches.items():
+            replaced.append((fn, getattr(fn.local_storage, 'result_cache', None)))
+            fn.local_storage.result_cache = result_cache
+        return replaced
+
+    def return_result_caches(self, replaced, adopt=False):
+        """put back what lend_result_caches replaced.  With 'adopt', the
+        calling thread keeps the lent result caches where it had none."""
+        for fn, result_cache in replaced:
+            if result_cache is None:
+                if not adopt:
+                    del fn.local_storage.result_cache
+            else:
+                fn.local_storage.result_cache = result_cache
+
+    def keep_result_caches(self):
+        """take the result cache of every function the evaluation still
+        depends on from the calling thread, unless it has it already"""
+        involved = set(self.evaluation.execution_stack.functions)
+        for dependencies in self.evaluation.pinned_dependencies.values():
+            involved.update(fn for fn, redemption_token in dependencies)
+        for fn in involved:
+            if fn not in self.result_caches:
+                result_cache = self.result_caches[fn] = get_result_cache(fn)
+                if not isinstance(result_cache, SharedResultCache):
+                    del fn.local_storage.result_cache
+
+
+class AwaitedCall(object):
+    """what awaiting an UnknownValue gives: the unknown is passed up to the
+    GeneratorStack driving the coroutine, and the result sent back down
+    becomes the value of the await expression."""
+    __slots__ = ('unknown', 'passed_up')
 
+    def __init__(self, unknown):
+        self.unknown = unknown
+        self.passed_up = False
 
+    def __iter__(self):
+        return self
+
+    def send(self, value):
+        if self.passed_up:
+            raise StopIteration(value)
+        self.passed_up = True
+        return self.unknown
+
+    def __next__(self):
+        return self.send(None)
+    next = __next__
 
-def execute_iteratively(fn):
+
+def execute_iteratively(
+    fn=None,
+    maxsize=None,
+    policy='lru',
+    cache='memo',
+    shared=False,
+    store=None,
+    parallel=None,
+    parallel_threshold=0,
+    parallel_grain=None,
+    cost=None,
+    steps_per_slice=1000,
+    key=None,
+    tail=False,
+    domain=None,
+    dtype=None,
+    vectorized=None,
+    stats=False,
+    on_push=None,
+    on_pop=None,
+    on_cache_hit=None,
+    on_result=None,
+    spill_threshold=None,
+    spill_directory=None,
+    profile=None
+):
     """this decorator takes a recursive function and ensures that it gets
     evalutated iteratively instead.  To be successful, the recursive method
     must have the following attributes:
        1. parameters passed in must be hashable and static.
        2. return is used as the method of getting results, no side effects.
-       3. the value returned must be 'mockable'.
+       3. the value returned must tolerate being stood in for by an
+          UnknownValue: arithmetic, comparisons, indexing, attribute access
+          and calls on it are absorbed.
 
     The decorator accomplishes the task by trapping each call to the recurisive
     method.  There are three outcomes:
@@ -161,80 +2102,561 @@ def execute_iteratively(fn):
           recurse beyond this level, the call is trapped and forced to return
           an "Unknown" with a redemption key that is the args/kwargs that was
           attempted in the recursive call.
+
+    By default, the memo never forgets.  Used with arguments, the memo holds
+    at most 'maxsize' results, evicting by the given 'policy' ('lru' or
+    'fifo'):
+
+        @execute_iteratively(maxsize=10000)
+        def fact(n):
+            ...
+
+    As with functools.lru_cache, the decorated function gains 'cache_info()'
+    and 'cache_clear()', which apply to the calling thread's memo.  Results
+    still needed by the evaluation in progress are never evicted.
+
+    With cache='evaluation', results are kept only for as long as the
+    evaluation in progress still needs them (see EvaluationResultCache).
+    That suits functions whose intermediate results are large and used only
+    once, like sublists in a quicksort.
+
+    With shared=True, there is a single memo for all threads rather than one
+    per thread, and a thread never computes a result that another thread is
+    already computing (see SharedResultCache).
+
+    With a 'store', such as store=SqliteStore(path), results also persist
+    beyond the life of the process.  The store is read whenever the memo
+    misses and is written to as results are computed, so other processes
+    and restarts begin warm.
+
+    With 'parallel', a concurrent.futures style executor such as a
+    ProcessPoolExecutor, sub-problems discovered together by one execution
+    of a body are taken to be independent and are resolved concurrently (see
+    ExecutionStack.dispatch).  Only those whose 'cost', called with their
+    args and kwargs, is at least 'parallel_threshold' are sent to workers.
+    Those costing more than 'parallel_grain' are split further first, which
+    spreads the work evenly over the workers:
+
+        @execute_iteratively(
+            parallel=ProcessPoolExecutor(),
+            parallel_threshold=10000,
+            parallel_grain=len(values) // 32,
+            cost=len
+        )
+        def i_quicksort(value_sequence):
+            ...
+
+    Without a 'cost', every sub-problem is sent.  Results are the same as a
+    serial evaluation, but sub-problems that overlap, like those of the
+    fibonacci function, end up computed more than once.
+
+    'fn.map(iterable)' returns the results for many calls at once, and
+    'fn.imap(iterable)' yields them as they become known.  As with the map
+    builtin, several iterables give several args for each call.  The calls
+    all share one evaluation, rather than each starting its own.  With
+    'order', a function of a call's args, the calls are evaluated in that
+    order, which can be chosen to get the most out of the memo (smallest
+    first for fib, say).  Results come back in the original order either
+    way.
+
+    'fn.evaluate(args, kwargs, max_steps, deadline)' stops after 'max_steps'
+    body executions, or once time.time() passes 'deadline', returning a
+    PendingEvaluation that can be resumed later, on any thread, if the
+    result wasn't found by then.
+
+    Within an asyncio event loop, 'await fn.evaluate_async(*args, **kwargs)'
+    evaluates on a stack of its own, giving the loop a turn after every
+    'steps_per_slice' body executions (see AsyncEvaluation).
+
+    Calls are memoized by their arguments, which are frozen into a hashable
+    form first when need be (see RedemptionToken).  For large arguments a
+    'key', called with the same args and kwargs as the function, can give
+    something cheaper to hash and compare.  Calls with equal keys share a
+    result:
+
+        @execute_iteratively(key=lambda board, depth: (board.digest, depth))
+        def best_move(board, depth):
+            ...
+
+    With tail=True, the function declares that it only ever calls itself in
+    tail position, returning that call's result unchanged:
+
+        @execute_iteratively(tail=True)
+        def gcd(a, b):
+            if b == 0:
+                return a
+            return gcd(b, a % b)
+
+    Such calls are then run in a loop, one after another, rather than pushed
+    onto the stack, replayed and memoized level by level.  Memory stays
+    constant however deep the recursion goes, and only the outermost call is
+    memoized.  Calls to other decorated functions, mutual recursion included,
+    are evaluated as usual.
+
+    With a 'domain', a function of small integer args, like fib(n) or
+    dp(i, j), is tabulated bottom up rather than evaluated top down.  The
+    domain gives a (low, high) range for each arg, high excluded, or just
+    high for a range starting at 0:
+
+        @execute_iteratively(domain=[(0, 1000), (0, 1000)])
+        def dp(i, j):
+            ...
+
+    A call in the domain fills a table, one cell at a time in row major
+    order, up to the cell for the call.  Recursive calls to cells already
+    filled are simple lookups.  Anything else, from calls outside the
+    domain to calls ahead of the filling, falls back to the usual stack.
+    'dtype', an array module typecode, makes the table compact, and a
+    'vectorized' recurrence fills it a row at a time (see Tabulation).
+
+    With stats=True, 'fn.stats()' reports how much work evaluations of the
+    function have done on the calling thread, and 'fn.stats_clear()' starts
+    the counts again.  Hooks, 'on_push', 'on_pop', 'on_cache_hit' and
+    'on_result', are called as the evaluation goes, say to feed a metrics
+    pipeline, and imply stats=True (see Instrumentation).  So does a
+    'profile', a DependencyProfile recording which calls waited on which,
+    and how often and for how long each body ran.  Without any of these,
+    the function costs no more to evaluate than it ever did.
+
+    The stack of an evaluation is kept in memory (see FrameStack).  With a
+    'spill_threshold', at least 1, a recursion deeper than that many frames
+    keeps only the newest of them in memory, the older ones going to a
+    temporary file in 'spill_directory' until they are needed again.  The
+    results they wait on go with them, so with cache='evaluation' or a
+    'maxsize' the depth is bounded by disk rather than memory.  The default
+    memo keeps every result in memory regardless.  Args and results must be
+    picklable for that.  The setting of the function whose call starts an
+    evaluation applies to the whole of it.
     """
-    def create_unknown(*outer_args, **outer_kwargs):
-        redemption_token=RedemptionToken(*outer_args, **outer_kwargs)
-        class TaggedUnknownValue(UnknownValue):
-            """Each set of recursive method arguments has its own
-            TaggedUnknownValue type.  They contain a reference to the
-            recursive function being wrapped by the decorator as well as
-            a reference to the redemption token.
-
-            by defining this within the scope of this method, the underlying
-            MagicMock will know about both 'fn' and the 'redemption_token'.
-            That means that any children of that MagicMock will also have
-            those values. This enables statements like:
-                return fn(n - 1) * n
-            to return a child mock that still has the context of the original
-            call.
-            """
-            def __init__(self, *args, **kwargs):
-                super(UnknownValue, self).__init__(
-                    defining_function=fn,
-                    redemption_token=redemption_token,
-                )
+    if fn is None:
+        return lambda fn: execute_iteratively(
+            fn,
+            maxsize=maxsize,
+            policy=policy,
+            cache=cache,
+            shared=shared,
+            store=store,
+            parallel=parallel,
+            parallel_threshold=parallel_threshold,
+            parallel_grain=parallel_grain,
+            cost=cost,
+            steps_per_slice=steps_per_slice,
+            key=key,
+            tail=tail,
+            domain=domain,
+            dtype=dtype,
+            vectorized=vectorized,
+            stats=stats,
+            on_push=on_push,
+            on_pop=on_pop,
+            on_cache_hit=on_cache_hit,
+            on_result=on_result,
+            spill_threshold=spill_threshold,
+            spill_directory=spill_directory,
+            profile=profile
+        )
 
-            def __repr__(self):
-                return str((
-                    self.defining_function.func_name,
-                    self.redemption_token.args,
-                    self.redemption_token.kwargs
-                ))
-        future = TaggedUnknownValue()
-        return future
+    if tail:
+        body = fn
+
+        @wraps(body)
+        def tail_loop(*args, **kwargs):
+            """run the body, then run it again in place for each call it
+            makes to itself, until one of them returns a value.  Each call
+            has the same result as the one before it, so only the first is
+            ever pushed onto the stack or memoized."""
+            evaluation = ExecutionStack.current()
+            local_storage = tail_loop.local_storage
+            first_redemption_token = make_token(*args, **kwargs)
+            try:
+                resume_points = local_storage.resume_points
+            except AttributeError:
+                resume_points = local_storage.resume_points = {}
+            args, kwargs = resume_points.pop(first_redemption_token, (args, kwargs))
+            previous_evaluation = getattr(local_storage, 'tail_loop_evaluation', None)
+            local_storage.tail_loop_evaluation = evaluation
+            try:
+                result = body(*args, **kwargs)
+                while isinstance(result, TailCall):
+                    if evaluation.discovered_unknowns:
+                        # the body ran into calls to other functions that
+                        # aren't known yet.  This frame will be replayed once
+                        # they are, and can pick up from the call it was on.
+                        resume_points[first_redemption_token] = (args, kwargs)
+                        return result
+                    args, kwargs = result.args, result.kwargs
+                    result = body(*args, **kwargs)
+                return result
+            finally:
+                local_storage.tail_loop_evaluation = previous_evaluation
+
+        fn = tail_loop
+    else:
+        fn = copy_function(fn)
+
+    if cache not in ('memo', 'evaluation'):
+        raise ValueError(
+            "cache must be 'memo' or 'evaluation', not %r" % (cache,)
+        )
+    if domain is not None:
+        if shared:
+            raise ValueError("shared=True can't be combined with a domain")
+        domain = [
+            (0, bounds) if isinstance(bounds, integer_types) else tuple(bounds)
+            for bounds in domain
+        ]
+        fn.make_tabulation = lambda: Tabulation(
+            fn,
+            domain,
+            dtype=dtype,
+            vectorized=vectorized
+        )
+    elif dtype is not None or vectorized is not None:
+        raise ValueError('dtype and vectorized need a domain')
+    if spill_threshold is not None and spill_threshold < 1:
+        raise ValueError(
+            'spill_threshold must be at least 1, not %r' % (spill_threshold,)
+        )
+    if shared:
+        if maxsize is not None or cache != 'memo':
+            raise ValueError(
+                "shared=True can't be combined with maxsize or cache='evaluation'"
+            )
+        shared_result_cache = SharedResultCache()
+        fn.make_result_cache = lambda: shared_result_cache
+    elif cache == 'evaluation':
+        if maxsize is not None:
+            raise ValueError("maxsize cannot be used with cache='evaluation'")
+        fn.make_result_cache = EvaluationResultCache
+    elif maxsize is None:
+        fn.make_result_cache = ResultCache
+    elif policy in BoundedResultCache.policies:
+        fn.make_result_cache = lambda: BoundedResultCache(maxsize, policy)
+    else:
+        raise ValueError(
+            'policy must be one of %s, not %r' % (
+                BoundedResultCache.policies,
+                policy
+            )
+        )
+    fn.store = store
+    fn.spill = None if spill_threshold is None else (spill_threshold, spill_directory)
+    fn.local_storage = threading.local()
+    if key is None:
+        make_token = RedemptionToken
+    else:
+        make_token = lambda *args, **kwargs: RedemptionToken.with_key(
+            key(*args, **kwargs),
+            args,
+            kwargs
+        )
 
     @wraps(fn)
     def hijacked_fn(*args, **kwargs):
         """This is the method that actually replaces the recursive function
         and traps the calls to that function. """
 
-        local_redemption_token = RedemptionToken(*args, **kwargs)
+        if domain is not None:
+            tabulation = get_tabulation(fn)
+            flat = tabulation.flat_index(args, kwargs)
+            if flat is not None:
+                if flat < tabulation.filled:
+                    return tabulation.get(flat)
+                if not tabulation.filling:
+                    return tabulation.evaluate(flat)
+
+        if tail:
+            tail_loop_evaluation = getattr(fn.local_storage, 'tail_loop_evaluation', None)
+            if tail_loop_evaluation is not None and tail_loop_evaluation is ExecutionStack.current():
+                # a call from the body to itself, which the tail loop runs
+                return TailCall(args, kwargs)
+
+        local_redemption_token = make_token(*args, **kwargs)
 
         try:
-            if local_redemption_token in fn.local_storage.result_cache:
-                # memoizing trap for calls to original function
-                result = fn.local_storage.result_cache[local_redemption_token]
-                return result
-        except AttributeError:
-            fn.local_storage = threading.local()
-            fn.local_storage.result_cache = {}
-            fn.local_storage.in_use = False
+            # memoizing trap for calls to original function
+            return recall(local_redemption_token)
+        except KeyError:
+            pass
 
-        if fn.local_storage.in_use:
+        if ExecutionStack.is_in_use():
             # trap to capture any attempts to recurse beyond the 2 level of
-            # the original function
-            result = create_unknown(*args, **kwargs)
+            # the original function, including calls made to it from the
+            # body of some other function under evaluation
+            for an_arg in args + tuple(kwargs.values()):
+                if isinstance(an_arg, UnknownValue):
+                    # a call like f(m - 1, f(m, n - 1)) can't be identified
+                    # until the inner call is known.  That one has already
+                    # been discovered, and the body will be replayed once it
+                    # is known.
+                    return an_arg
+            result = UnknownValue(fn, local_redemption_token)
+            ExecutionStack.discover(result)
+            if instrumentation is not None:
+                instrumentation.counters().unknowns += 1
             return result
         # this section is reached iff it is the original client call to
         # the original function
-        fn.local_storage.in_use = True
-        first_future = create_unknown(*args, **kwargs)
-        if not ExecutionStack.is_in_use():
-            ExecutionStack.get_execution_stack().append(first_future)
-##            print "PUSH", ExecutionStack.get_execution_stack()
-            try:
-                result = ExecutionStack.execute()
-            except BaseException:
-                # we've no idea what kind of exceptions could be raised
-                # by the function fn, so we've got to catch them all
-                # and make sure that the flag about fn in use has to get
-                # reset
-                fn.local_storage.in_use = False
+        return ExecutionStack.execute(UnknownValue(fn, local_redemption_token))
+
+    def recall(redemption_token):
+        """return the memoized result for 'redemption_token', from the memo
+        or else the store, raising KeyError if neither has it"""
+        result_cache = get_result_cache(fn)
+        try:
+            result = result_cache[redemption_token]
+        except KeyError:
+            result_cache.misses += 1
+            if instrumentation is not None:
+                instrumentation.counters().misses += 1
+            if store is None:
                 raise
+            result = store.get(fn, redemption_token)
+            result_cache[redemption_token] = result
+            return result
         else:
-            return first_future
+            result_cache.hits += 1
+            if instrumentation is not None:
+                instrumentation.counters().hits += 1
+                if instrumentation.on_cache_hit is not None:
+                    instrumentation.on_cache_hit(
+                        hijacked_fn,
+                        redemption_token.args,
+                        redemption_token.kwargs
+                    )
+            return result
 
-        fn.local_storage.in_use = False
-        return result
+    def evaluate_async(*args, **kwargs):
+        """return an awaitable for the result of the decorated function that
+        yields to the event loop as it goes"""
+        local_redemption_token = make_token(*args, **kwargs)
+        try:
+            evaluation = ExecutionStack()
+            evaluation.result = recall(local_redemption_token)
+        except KeyError:
+            evaluation = ExecutionStack(UnknownValue(fn, local_redemption_token))
+        return AsyncEvaluation(evaluation, steps_per_slice)
+
+    def imap(*iterables, **kwargs):
+        """return an iterator of the results of the decorated function for
+        the args drawn from the iterables, in their order, that evaluates
+        all of them together"""
+        order = kwargs.pop('order', None)
+        if kwargs:
+            raise TypeError(
+                'imap() got unexpected keyword arguments: %s' % ', '.join(kwargs)
+            )
+        redemption_tokens = [make_token(*args) for args in zip(*iterables)]
+        return evaluate_together(redemption_tokens, order)
+
+    def unknown_together(redemption_tokens):
+        """return an ExecutionStack for those of the 'redemption_tokens' the
+        memo doesn't know, the first on top"""
+        unknowns = []
+        for a_redemption_token in reversed(redemption_tokens):
+            try:
+                recall(a_redemption_token)
+            except KeyError:
+                unknowns.append(UnknownValue(fn, a_redemption_token))
+        return ExecutionStack(*unknowns)
+
+    def evaluate_together(redemption_tokens, order):
+        result_cache = get_result_cache(fn)
+        # whatever happens to the memo, the results must stay until they
+        # are yielded
+        for a_redemption_token in redemption_tokens:
+            result_cache.pin(a_redemption_token)
+        position = 0
+        try:
+            if order is None:
+                evaluation_order = redemption_tokens
+            else:
+                evaluation_order = sorted(
+                    redemption_tokens,
+                    key=lambda token: order(*token.args, **token.kwargs)
+                )
+            evaluation = unknown_together(evaluation_order)
+            try:
+                while position < len(redemption_tokens):
+                    if evaluation.run(steps_per_slice) and position < len(redemption_tokens):
+                        try:
+                            result_cache[redemption_tokens[position]]
+                        except KeyError:
+                            # the evaluation is over, yet results not yielded
+                            # yet have gone, the memo cleared meanwhile, say.
+                            # They are worked out again.
+                            evaluation = unknown_together(
+                                redemption_tokens[position:]
+                            )
+                    while position < len(redemption_tokens):
+                        try:
+                            result = result_cache[redemption_tokens[position]]
+                        except KeyError:
+                            break
+                        result_cache.unpin(redemption_tokens[position])
+                        position += 1
+                        yield result
+            finally:
+                if not evaluation.done:
+                    # given up on before the end
+                    evaluation.abandon()
+        finally:
+            for a_redemption_token in redemption_tokens[position:]:
+                result_cache.unpin(a_redemption_token)
+
+    def map(*iterables, **kwargs):
+        """return a list of the results of the decorated function for the
+        args drawn from the iterables, evaluating all of them together"""
+        return list(imap(*iterables, **kwargs))
+
+    def evaluate(args=(), kwargs=None, max_steps=None, deadline=None):
+        """return the result of the decorated function for args/kwargs if
+        it can be found within 'max_steps' body executions and before
+        time.time() passes 'deadline', or else a PendingEvaluation"""
+        if kwargs is None:
+            kwargs = {}
+        local_redemption_token = make_token(*args, **kwargs)
+        try:
+            return recall(local_redemption_token)
+        except KeyError:
+            pass
+        return PendingEvaluation(
+            ExecutionStack(UnknownValue(fn, local_redemption_token))
+        ).resume(max_steps, deadline)
+
+    def cache_info():
+        """report on the calling thread's memo for the decorated function,
+        or the shared memo"""
+        return get_result_cache(fn).info()
+
+    def cache_clear():
+        """empty the calling thread's memo for the decorated function, or the
+        shared memo"""
+        get_result_cache(fn).clear()
+        if domain is not None:
+            fn.local_storage.tabulation = fn.make_tabulation()
+
+    def report_stats():
+        """report on the work done evaluating the decorated function on the
+        calling thread, or None without stats=True"""
+        if instrumentation is None:
+            return None
+        return instrumentation.stats()
+
+    def clear_stats():
+        """start the calling thread's counts for stats() again"""
+        if instrumentation is not None:
+            instrumentation.clear()
+
+    hijacked_fn.defining_function = fn
+    hijacked_fn.cache_info = cache_info
+    hijacked_fn.cache_clear = cache_clear
+    hijacked_fn.evaluate_async = evaluate_async
+    hijacked_fn.map = map
+    hijacked_fn.evaluate = evaluate
+    hijacked_fn.imap = imap
+    hijacked_fn.stats = report_stats
+    hijacked_fn.stats_clear = clear_stats
+    if stats or on_push or on_pop or on_cache_hit or on_result or profile is not None:
+        instrumentation = Instrumentation(
+            hijacked_fn,
+            on_push=on_push,
+            on_pop=on_pop,
+            on_cache_hit=on_cache_hit,
+            on_result=on_result,
+            profile=profile
+        )
+    else:
+        instrumentation = None
+    fn.instrumentation = instrumentation
+    if parallel is None:
+        fn.parallel = None
+    else:
+        fn.parallel = (
+            parallel,
+            parallel_threshold,
+            parallel_grain,
+            cost,
+            hijacked_fn
+        )
     return hijacked_fn
 
+
+
+def execute_as_generator(fn=None, steps_per_slice=1000):
+    """a companion to execute_iteratively for recursive functions written as
+    generators.  Each recursive call is yielded rather than used directly,
+    and its value is sent back in as the result of the yield:
+
+        @execute_as_generator
+        def fact(n):
+            if n < 2:
+                yield 1
+            else:
+                result = yield fact(n - 1)
+                yield result * n
+
+    The first value yielded that is not a recursive call is the result of the
+    function (under Python 3, 'return value' works as well).
+
+    Rather than replaying function bodies, the decorator suspends each
+    generator at the point where it yields a recursive call and resumes it
+    when that value is known (see GeneratorStack).  The body runs exactly once
+    per distinct set of arguments, so non-recursive work is never repeated.
+    Results are memoized as they are with execute_iteratively, and the
+    recursion depth is limited only by memory.
+
+    A call that is not yielded from within another generator function's body
+    is treated as a request to evaluate, so recursive calls must always be
+    yielded, never buried in a helper function.
+
+    Under Python 3.5 and later, 'async def' functions work too, with their
+    recursive calls awaited rather than yielded:
+
+        @execute_as_generator
+        async def fact(n):
+            if n < 2:
+                return 1
+            return await fact(n - 1) * n
+
+    Called from outside an evaluation, such a function returns an awaitable
+    that hands anything else the coroutines await to the event loop, and
+    gives the loop a turn after every 'steps_per_slice' resumptions (see
+    AsyncEvaluation).  'fn.evaluate_async' gives the same awaitable for
+    generator functions.
+    """
+    if fn is None:
+        return lambda fn: execute_as_generator(fn, steps_per_slice)
+
+    fn = copy_function(fn)
+    fn.make_result_cache = ResultCache
+    fn.store = None
+    fn.spill = None
+    fn.parallel = None
+    fn.instrumentation = None
+    fn.local_storage = threading.local()
+
+    @wraps(fn)
+    def generator_fn(*args, **kwargs):
+        """This is the method that actually replaces the recursive generator
+        function.  Within an evaluation, it only announces which call is
+        wanted, leaving the generator to yield it to the GeneratorStack."""
+        call = UnknownValue(fn, RedemptionToken(*args, **kwargs))
+        if GeneratorStack.is_in_use():
+            return call
+        if is_coroutine_function:
+            return AsyncEvaluation(GeneratorStack(call), steps_per_slice)
+        return GeneratorStack.execute(call)
+
+    def evaluate_async(*args, **kwargs):
+        """return an awaitable for the result of the decorated function that
+        yields to the event loop as it goes"""
+        return AsyncEvaluation(
+            GeneratorStack(UnknownValue(fn, RedemptionToken(*args, **kwargs))),
+            steps_per_slice
+        )
+
+    is_coroutine_function = is_coroutine_fn(fn)
+    generator_fn.defining_function = fn
+    generator_fn.evaluate_async = evaluate_async
+    return generator_fn
@@ -1,7 +1,55 @@
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from collections import Sequence
+try:
+    from collections.abc import Sequence
+except ImportError:
+    # before Python 3.3
+    from collections import Sequence
 
-from reitercurse import execute_iteratively
+try:
+    import tracemalloc
+except ImportError:
+    # not available before Python 3.4
+    tracemalloc = None
+
+try:
+    import asyncio
+except ImportError:
+    # not available before Python 3.4
+    asyncio = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # not available before Python 3.2
+    ProcessPoolExecutor = None
+
+if ProcessPoolExecutor is not None and 'fork' in multiprocessing.get_all_start_methods():
+    # worker processes started any other way import this module afresh,
+    # and don't see parallel_quicksort as decorated at runtime
+    fork_context = multiprocessing.get_context('fork')
+else:
+    fork_context = None
+
+from reitercurse import (
+    execute_iteratively,
+    execute_as_generator,
+    DependencyProfile,
+    ExecutionStack,
+    get_result_cache,
+    PendingEvaluation,
+    RedemptionToken,
+    SqliteStore,
+    UnknownValue,
+)
 
 i_in_out = []
 
@@ -22,6 +70,84 @@ def memo(fn):
     return wrapped
 
 
+class ThreadExecutor(object):
+    """just enough of a concurrent.futures executor, running each call in a
+    thread of its own"""
+
+    class Future(object):
+        def __init__(self, fn, args):
+            self.thread = threading.Thread(target=self.run, args=(fn, args))
+            self.thread.start()
+
+        def run(self, fn, args):
+            self.value = fn(*args)
+
+        def result(self):
+            self.thread.join()
+            return self.value
+
+        def cancel(self):
+            return False
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        return self.Future(fn, args)
+
+
+def parallel_quicksort(value_sequence):
+    # decorated by test_execute_iteratively_parallel_processes, workers
+    # in other processes have to be able to find it by name, and so are
+    # forked from the process that decorated it
+    if not value_sequence:
+        return []
+    pivots = [x for x in value_sequence if x == value_sequence[0]]
+    lesser = parallel_quicksort([x for x in value_sequence if x < value_sequence[0]])
+    greater = parallel_quicksort([x for x in value_sequence if x > value_sequence[0]])
+    return lesser + pivots + greater
+
+
+# 'async def' is a syntax error before Python 3.5, so the coroutine
+# functions for the asyncio tests are compiled only when they're wanted
+ASYNC_FUNCTIONS = """
+@execute_as_generator(steps_per_slice=50)
+async def afact(n):
+    bodies.append(n)
+    if n < 2:
+        return 1
+    if n % 500 == 0:
+        # something only the event loop can deal with
+        await asyncio.sleep(0)
+    return await afact(n - 1) * n
+
+@execute_as_generator
+async def afib(n):
+    if n < 3:
+        return n
+    return await afib(n - 1) + await afib(n - 2)
+
+@execute_as_generator
+async def await_failing(n, failing, catch_at):
+    try:
+        if n == 0:
+            return await failing
+        return await await_failing(n - 1, failing, catch_at) + 1
+    except ValueError:
+        if n != catch_at:
+            raise
+        return -n
+"""
+
+
+def reduce_product(low, high):
+    product = 1
+    for n in range(low, high + 1):
+        product *= n
+    return product
+
+
 calls = 0
 
 def recursion_watch(fn):
@@ -181,6 +307,9 @@ class TestCase(unittest.TestCase):
             r1 = execute_with_recursion_watch(ifib1, n)
             r2 = rfib(n)
             self.assertEqual(r1, r2)
+        # ifib2 was only ever reached through ifib1, it must still be
+        # callable on its own
+        self.assertEqual(execute_with_recursion_watch(ifib2, 150), rfib(150))
 
     def test_execute_iteratively_mutable_argument(self):
         @recursion_watch
@@ -216,3 +345,1227 @@ class TestCase(unittest.TestCase):
         # not sure why this RuntimeError is not caught by the assert
         #self.assertRaises(RuntimeError, r_quicksort(range(1111, 0, -1)))
 
+    def test_execute_iteratively_nested_calls(self):
+        @execute_iteratively
+        def ackermann(m, n):
+            if m == 0:
+                return n + 1
+            if n == 0:
+                return ackermann(m - 1, 1)
+            return ackermann(m - 1, ackermann(m, n - 1))
+
+        self.assertEqual(ackermann(2, 3), 9)
+        # deeper than the recursion limit
+        self.assertEqual(ackermann(3, 9), 4093)
+
+    def test_execute_iteratively_tail(self):
+        bodies = [0]
+
+        @execute_iteratively(tail=True)
+        def count_up(n, total=0):
+            bodies[0] += 1
+            if n == 0:
+                return total
+            return count_up(n - 1, total + n)
+
+        self.assertEqual(count_up(100000), sum(range(100001)))
+        # no replays, and nothing memoized but the outermost call
+        self.assertEqual(bodies[0], 100001)
+        self.assertEqual(count_up.cache_info().currsize, 1)
+
+        @execute_iteratively(tail=True)
+        def gcd(a, b):
+            if b == 0:
+                return a
+            return gcd(b, a % b)
+        self.assertEqual(gcd(2 ** 40 * 3 ** 5, 2 ** 30 * 3 ** 20), 2 ** 30 * 3 ** 5)
+
+    def test_execute_iteratively_tail_with_other_unknowns(self):
+        squares = []
+
+        @execute_iteratively
+        def square(n):
+            squares.append(n)
+            return n * n
+
+        bodies = [0]
+
+        @execute_iteratively(tail=True)
+        def sum_of_squares(n, total=0):
+            bodies[0] += 1
+            if n == 0:
+                return total
+            return sum_of_squares(n - 1, total + square(n))
+
+        @execute_iteratively
+        def twice_the_sum_of_squares(n):
+            return 2 * sum_of_squares(n)
+
+        self.assertEqual(
+            twice_the_sum_of_squares(1000),
+            2 * sum(x * x for x in range(1001))
+        )
+        self.assertEqual(len(squares), 1000)
+        # each replay picks up from the call that ran into an unknown
+        # square, rather than starting over
+        self.assertEqual(bodies[0], 2 * 1000 + 1)
+        self.assertEqual(sum_of_squares.cache_info().currsize, 1)
+
+    def test_execute_iteratively_domain(self):
+        bodies = []
+
+        @execute_iteratively(domain=[1000])
+        def ifib(n):
+            bodies.append(n)
+            if n < 3:
+                return n
+            return ifib(n - 1) + ifib(n - 2)
+
+        a, b = 1, 2
+        for x in range(997):
+            a, b = b, a + b
+        self.assertEqual(ifib(999), b)
+        # once per cell, bottom up, with nothing memoized
+        self.assertEqual(bodies, list(range(1000)))
+        self.assertEqual(ifib.cache_info().currsize, 0)
+        # beyond the domain, the stack takes over as far as the table
+        self.assertEqual(ifib(1001), ifib(999) + 2 * ifib(998) + ifib(997))
+        self.assertEqual(ifib.cache_info().currsize, 2)
+
+        @execute_iteratively(domain=[(0, 20)])
+        def count_to_ten(n):
+            # ahead of the filling, so left to the stack
+            if n == 10:
+                return 0
+            return count_to_ten(n + 1) + 1
+        self.assertEqual(count_to_ten(0), 10)
+
+    def test_execute_iteratively_domain_table_types(self):
+        def first_row_and_column_ones(lattice_paths):
+            def paths(i, j):
+                if i == 0 or j == 0:
+                    return 1
+                return lattice_paths(i - 1, j) + lattice_paths(i, j - 1)
+            return paths
+
+        @execute_iteratively(domain=[(0, 20), (0, 20)], dtype='d')
+        def compact_paths(i, j):
+            return first_row_and_column_ones(compact_paths)(i, j)
+
+        def next_row(table, i):
+            if i == 0:
+                return [1] * 30
+            return [sum(table[i - 1][:j + 1]) for j in range(30)]
+
+        @execute_iteratively(domain=[(0, 30), (0, 30)], vectorized=next_row)
+        def vectorized_paths(i, j):
+            return first_row_and_column_ones(vectorized_paths)(i, j)
+
+        # central binomial coefficients, C(38, 19) and C(58, 29)
+        self.assertEqual(compact_paths(19, 19), 35345263800)
+        self.assertEqual(vectorized_paths(29, 29), 30067266499541040)
+        self.assertRaises(ValueError, execute_iteratively(dtype='d'), len)
+
+    def test_execute_iteratively_map(self):
+        bodies = []
+
+        @execute_iteratively(cache='evaluation')
+        def ifib(n):
+            bodies.append(n)
+            if n < 3:
+                return n
+            return ifib(n - 1) + ifib(n - 2)
+
+        expected = [ifib(n) for n in range(300)]
+        # called one at a time, nothing is kept from one call to the next
+        self.assertTrue(len(bodies) > 300 * 300 // 2)
+
+        del bodies[:]
+        self.assertEqual(ifib.map(range(300)), expected)
+        # evaluated together, each body is replayed at most once
+        self.assertTrue(len(bodies) < 2 * 300)
+
+        del bodies[:]
+        self.assertEqual(
+            ifib.map(range(299, -1, -1), order=lambda n: n),
+            expected[::-1]
+        )
+        self.assertTrue(len(bodies) < 2 * 300)
+        self.assertEqual(ifib.cache_info().currsize, 0)
+
+        @execute_iteratively
+        def add(a, b):
+            return a + b
+        self.assertEqual(add.map([1, 2, 3], [10, 20, 30]), [11, 22, 33])
+
+    def test_execute_iteratively_imap(self):
+        bodies = []
+
+        @execute_iteratively(cache='evaluation', steps_per_slice=10)
+        def split_sum(low, high):
+            bodies.append((low, high))
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            return split_sum(low, middle) + split_sum(middle, high)
+
+        results = split_sum.imap([0, 0, 1000], [1, 1000, 2000])
+        self.assertEqual(next(results), 0)
+        # streamed, so the rest is yet to be computed
+        self.assertTrue(len(bodies) < 20)
+        self.assertEqual(next(results), sum(range(1000)))
+        # given up on halfway, leaving nothing behind
+        results.close()
+        self.assertEqual(split_sum.cache_info().currsize, 0)
+        self.assertEqual(split_sum(1000, 2000), sum(range(1000, 2000)))
+
+        # results lost before they are yielded are worked out again
+        @execute_iteratively
+        def isum(n):
+            if n < 1:
+                return 0
+            return isum(n - 1) + n
+        results = isum.imap(range(50, 60))
+        self.assertEqual(next(results), sum(range(51)))
+        isum.cache_clear()
+        self.assertEqual(
+            list(results),
+            [sum(range(n + 1)) for n in range(51, 60)]
+        )
+
+    def test_execute_iteratively_evaluate(self):
+        bodies = [0]
+
+        def split_sum(low, high):
+            bodies[0] += 1
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            return i_split_sum(low, middle) + i_split_sum(middle, high)
+
+        for options in ({}, {'cache': 'evaluation'}, {'shared': True}):
+            i_split_sum = execute_iteratively(**options)(split_sum)
+            bodies[0] = 0
+            outcome = i_split_sum.evaluate((0, 4096), max_steps=100)
+            self.assertTrue(isinstance(outcome, PendingEvaluation))
+            self.assertEqual(bodies[0], 100)
+            slices = 1
+            while isinstance(outcome, PendingEvaluation):
+                # carried on by whichever thread is free
+                if slices % 2:
+                    outcomes = []
+                    worker = threading.Thread(
+                        target=lambda: outcomes.append(outcome.resume(max_steps=500))
+                    )
+                    worker.start()
+                    worker.join()
+                    outcome = outcomes[0]
+                else:
+                    outcome = outcome.resume(max_steps=500)
+                slices += 1
+            self.assertEqual(outcome, sum(range(4096)))
+            # nothing was lost between slices
+            self.assertEqual(bodies[0], 2 * 4095 + 4096)
+
+        i_split_sum = execute_iteratively(cache='evaluation')(split_sum)
+        outcome = i_split_sum.evaluate((0, 4096), deadline=time.time() - 1)
+        self.assertTrue(isinstance(outcome, PendingEvaluation))
+        outcome = outcome.resume(max_steps=1000)
+        kept_result_cache = outcome.result_caches[i_split_sum.defining_function]
+        self.assertTrue(len(kept_result_cache) > 0)
+        outcome.cancel()
+        self.assertEqual(len(kept_result_cache), 0)
+        self.assertEqual(i_split_sum.evaluate((0, 16)), sum(range(16)))
+
+        # while pending, the evaluation has its memo to itself, and the
+        # thread that started it carries on with a memo of its own
+        i_split_sum = execute_iteratively(maxsize=100)(split_sum)
+        outcome = i_split_sum.evaluate((0, 4096), max_steps=100)
+        kept_result_cache = outcome.result_caches[i_split_sum.defining_function]
+        self.assertTrue(get_result_cache(i_split_sum.defining_function) is not kept_result_cache)
+        outcomes = []
+
+        def finish():
+            pending = outcome
+            while isinstance(pending, PendingEvaluation):
+                pending = pending.resume(max_steps=50)
+            outcomes.append(pending)
+            # the thread that finished it keeps the memo
+            outcomes.append(get_result_cache(i_split_sum.defining_function) is kept_result_cache)
+        worker = threading.Thread(target=finish)
+        worker.start()
+        for high in range(1, 200):
+            self.assertEqual(i_split_sum(0, high), sum(range(high)))
+        worker.join()
+        self.assertEqual(outcomes, [sum(range(4096)), True])
+        self.assertTrue(get_result_cache(i_split_sum.defining_function) is not kept_result_cache)
+        self.assertTrue(i_split_sum.cache_info().currsize <= 100)
+        self.assertEqual(kept_result_cache.pins, {})
+
+    def test_execute_iteratively_spill(self):
+        bodies = [0]
+        spill_files = []
+
+        def count(n, fail_at=None):
+            bodies[0] += 1
+            if n == 0 or n == fail_at:
+                spill_files.append(ExecutionStack.current().execution_stack.spill_file)
+            if n == fail_at:
+                raise ZeroDivisionError(n)
+            if n == 0:
+                return 0
+            return i_count(n - 1, fail_at=fail_at) + 1
+
+        directory = tempfile.mkdtemp()
+        try:
+            for options in ({}, {'cache': 'evaluation'}, {'maxsize': 10}):
+                i_count = execute_iteratively(
+                    spill_threshold=100,
+                    spill_directory=directory,
+                    **options
+                )(count)
+                bodies[0] = 0
+                self.assertEqual(i_count(5000), 5000)
+                # spilling cost no extra replays
+                self.assertEqual(bodies[0], 2 * 5000 + 1)
+                # the frames did go to disk, and the file was closed after
+                self.assertTrue(spill_files[-1].closed)
+
+            # abandoned with frames on disk, nothing stays pinned
+            i_count = execute_iteratively(
+                maxsize=10,
+                spill_threshold=100,
+                spill_directory=directory
+            )(count)
+            self.assertRaises(ZeroDivisionError, i_count, 5000, fail_at=10)
+            self.assertTrue(spill_files[-1].closed)
+            self.assertEqual(get_result_cache(i_count.defining_function).pins, {})
+            outcome = i_count.evaluate((5000,), max_steps=2000)
+            self.assertTrue(isinstance(outcome, PendingEvaluation))
+            spill_file = outcome.evaluation.execution_stack.spill_file
+            self.assertFalse(spill_file.closed)
+            outcome.cancel()
+            self.assertTrue(spill_file.closed)
+            self.assertEqual(get_result_cache(i_count.defining_function).pins, {})
+            self.assertEqual(i_count(5000), 5000)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertRaises(
+            ValueError,
+            execute_iteratively(spill_threshold=0),
+            count
+        )
+
+        # frames waiting on several dependencies at once, some of them
+        # shared, spilled however small the threshold
+        def fib(n):
+            bodies[0] += 1
+            if n < 2:
+                return n
+            return i_fib(n - 1) + i_fib(n - 2)
+
+        for options in ({}, {'cache': 'evaluation'}, {'maxsize': 2}):
+            i_fib = execute_iteratively(**options)(fib)
+            bodies[0] = 0
+            expected = i_fib(20)
+            expected_bodies = bodies[0]
+            for spill_threshold in (1, 2, 3, 10):
+                i_fib = execute_iteratively(
+                    spill_threshold=spill_threshold,
+                    **options
+                )(fib)
+                bodies[0] = 0
+                self.assertEqual(i_fib(20), expected)
+                if not options:
+                    self.assertEqual(bodies[0], expected_bodies)
+                self.assertEqual(get_result_cache(i_fib.defining_function).pins, {})
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc is unavailable')
+    def test_execute_iteratively_spill_memory(self):
+        @execute_iteratively(cache='evaluation', spill_threshold=200)
+        def count(n):
+            if n == 0:
+                return 0
+            return count(n - 1) + 1
+
+        def peak_memory(depth):
+            tracemalloc.start()
+            try:
+                self.assertEqual(count(depth), depth)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        shallow = peak_memory(10000)
+        deep = peak_memory(40000)
+        # the frames on disk leave next to nothing behind in memory, where
+        # each would take hundreds of bytes otherwise
+        self.assertTrue(deep - shallow < 10 * 30000)
+
+    def test_redemption_token_freezes_nested_arguments(self):
+        self.assertEqual(
+            RedemptionToken([1, [2, 3]], {'a': [4]}),
+            RedemptionToken([1, [2, 3]], {'a': [4]})
+        )
+        self.assertEqual(
+            hash(RedemptionToken([1, [2, 3]], {'a': [4]})),
+            hash(RedemptionToken([1, [2, 3]], {'a': [4]}))
+        )
+        # values that don't compare equal don't share a token, however
+        # alike their frozen forms
+        self.assertNotEqual(
+            RedemptionToken([1, [2, 3]], {'a': [4]}),
+            RedemptionToken((1, (2, 3)), {'a': (4,)})
+        )
+        self.assertNotEqual(
+            RedemptionToken({'a': 1}),
+            RedemptionToken(set([('a', 1)]))
+        )
+        self.assertNotEqual(RedemptionToken([1]), RedemptionToken((1,)))
+        self.assertNotEqual(RedemptionToken([[1]]), RedemptionToken(([1],)))
+        self.assertNotEqual(
+            RedemptionToken({'a': 1, 'b': 2}),
+            RedemptionToken({'a': 1, 'b': 3})
+        )
+        self.assertNotEqual(
+            RedemptionToken(x=[[1], {2}]),
+            RedemptionToken(x=[[1], {3}])
+        )
+
+        @execute_iteratively
+        def nested_sum(value):
+            if isinstance(value, dict):
+                return sum(nested_sum(v) for v in value.values())
+            if isinstance(value, list):
+                return sum(nested_sum(v) for v in value)
+            return value
+        self.assertEqual(
+            nested_sum({'a': [1, [2, 3]], 'b': {'c': [4, 5]}, 'd': 6}),
+            21
+        )
+
+        @execute_iteratively
+        def kind(value):
+            return type(value).__name__
+        self.assertEqual(kind({'a': 1}), 'dict')
+        self.assertEqual(kind(set([('a', 1)])), 'set')
+        self.assertEqual(kind([1]), 'list')
+        self.assertEqual(kind(([1],)), 'tuple')
+
+    def test_execute_iteratively_key(self):
+        bodies = [0]
+
+        @execute_iteratively(key=lambda low, high, values: (low, high))
+        def k_sum(low, high, values):
+            bodies[0] += 1
+            if high - low == 1:
+                return values[low]
+            middle = (low + high) // 2
+            return k_sum(low, middle, values) + k_sum(middle, high, values)
+
+        values = list(range(512))
+        self.assertEqual(k_sum(0, 512, values), sum(values))
+        self.assertEqual(bodies[0], 2 * 511 + 512)
+        # the same key is the same call, whatever the values
+        bodies[0] = 0
+        self.assertEqual(k_sum(0, 256, None), sum(range(256)))
+        self.assertEqual(bodies[0], 0)
+
+
+    def test_unknown_value_absorbs_operators(self):
+        def f(n):
+            return n
+        unknown = UnknownValue(f, None)
+        self.assertTrue(unknown * 10 + 1 is unknown)
+        self.assertTrue(1 - unknown is unknown)
+        self.assertTrue([1, 2] + unknown is unknown)
+        self.assertTrue(unknown[3]['a'] is unknown)
+        self.assertTrue(unknown.some.attribute() is unknown)
+        self.assertTrue((unknown < 3) is unknown)
+        self.assertTrue(-unknown is unknown)
+        unknown.anything = 17
+        self.assertTrue(unknown.anything is unknown)
+        self.assertTrue(unknown.defining_function is f)
+        self.assertEqual(len(unknown), 0)
+        self.assertEqual(list(unknown), [])
+        self.assertEqual(int(unknown), 1)
+        self.assertTrue(unknown)
+        self.assertFalse(hasattr(unknown, '__length_hint__'))
+
+    def test_execute_as_generator_with_fact(self):
+        @execute_as_generator
+        def gfact(n):
+            if n < 2:
+                yield 1
+            else:
+                result = yield gfact(n - 1)
+                yield result * n
+
+        def rfact(n):
+            if n < 2:
+                return 1
+            else:
+                return rfact(n - 1) * n
+
+        for n in range(100):
+            self.assertEqual(gfact(n), rfact(n))
+        self.assertEqual(gfact(5000), gfact(4999) * 5000)
+
+    def test_execute_as_generator_runs_each_body_once(self):
+        bodies = []
+
+        @execute_as_generator
+        def gfib(n):
+            bodies.append(n)
+            if n < 3:
+                yield n
+            else:
+                a = yield gfib(n - 1)
+                b = yield gfib(n - 2)
+                yield a + b
+
+        a, b = 1, 2
+        for n in range(3, 501):
+            a, b = b, a + b
+
+        self.assertEqual(gfib(500), b)
+        self.assertEqual(sorted(bodies), list(range(1, 501)))
+
+    def test_execute_as_generator_mutable_argument(self):
+        bodies = []
+
+        @execute_as_generator
+        def g_quicksort(value_sequence):
+            bodies.append(1)
+            if not value_sequence:
+                yield []
+                return
+            pivots = [x for x in value_sequence if x == value_sequence[0]]
+            lesser = yield g_quicksort(
+                [x for x in value_sequence if x < value_sequence[0]]
+            )
+            greater = yield g_quicksort(
+                [x for x in value_sequence if x > value_sequence[0]]
+            )
+            yield lesser + pivots + greater
+
+        self.assertEqual(
+            g_quicksort(list(range(1111, 0, -1))),
+            list(range(1, 1112))
+        )
+        # 1111 non-empty sublists plus the single empty one
+        self.assertEqual(len(bodies), 1112)
+
+    def test_execute_as_generator_deep_failure(self):
+        @execute_as_generator
+        def gfact(n):
+            if n < 2:
+                raise ValueError('deep failure')
+            result = yield gfact(n - 1)
+            yield result * n
+
+        @execute_as_generator
+        def guarded(n):
+            try:
+                result = yield gfact(n)
+            except ValueError:
+                result = -1
+            yield result
+
+        self.assertRaises(ValueError, gfact, 3000)
+        self.assertEqual(guarded(3000), -1)
+
+    def test_execute_iteratively_discovers_all_pending_calls(self):
+        bodies = []
+
+        @execute_iteratively
+        def split_sum(low, high):
+            bodies.append((low, high))
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            return split_sum(low, middle) + split_sum(middle, high)
+
+        self.assertEqual(split_sum(0, 1024), sum(range(1024)))
+        # 1023 inner nodes, discovering both halves in their first execution
+        # and finishing in the replay, plus 1024 leaves executed just once.
+        # Discovering one half per execution would need three executions per
+        # inner node.
+        self.assertEqual(len(bodies), 2 * 1023 + 1024)
+
+    def test_execute_iteratively_stats_and_hooks(self):
+        events = []
+
+        def record(event):
+            return lambda fn, *args: events.append((event, fn.__name__) + args)
+
+        @execute_iteratively(
+            on_push=record('push'),
+            on_pop=record('pop'),
+            on_cache_hit=record('hit'),
+            on_result=record('result')
+        )
+        def split_sum(low, high):
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            return split_sum(low, middle) + split_sum(middle, high)
+
+        self.assertEqual(split_sum(0, 8), 28)
+        stats = split_sum.stats()
+        # 7 inner nodes executed twice, 8 leaves once
+        self.assertEqual(stats.executions, 22)
+        self.assertEqual(stats.replays, 7)
+        # each inner node traps both halves, then recalls them in its replay
+        self.assertEqual(stats.unknowns, 14)
+        self.assertEqual(stats.hits, 14)
+        self.assertEqual(stats.misses, 15)
+        # the root, then two more for each of three levels
+        self.assertEqual(stats.max_depth, 7)
+        self.assertTrue(stats.seconds > 0)
+
+        def count(event):
+            return len([x for x in events if x[0] == event])
+        self.assertEqual(count('push'), 14)
+        self.assertEqual(count('pop'), 22)
+        self.assertEqual(count('hit'), 14)
+        self.assertEqual(count('result'), 15)
+        self.assertEqual(events[0], ('pop', 'split_sum', (0, 8), {}))
+        self.assertEqual(events[1], ('push', 'split_sum', (4, 8), {}))
+        self.assertEqual(events[-1], ('result', 'split_sum', (0, 8), {}, 28))
+
+        split_sum.stats_clear()
+        self.assertEqual(split_sum(0, 8), 28)
+        self.assertEqual(split_sum.stats()[:5], (0, 0, 1, 0, 0))
+
+        @execute_iteratively
+        def uninstrumented(n):
+            return n
+        uninstrumented(1)
+        self.assertEqual(uninstrumented.stats(), None)
+
+    def test_execute_iteratively_profile(self):
+        profile = DependencyProfile()
+
+        @execute_iteratively(profile=profile)
+        def is_even(n):
+            if n == 0:
+                return True
+            return is_odd(n - 1)
+
+        @execute_iteratively(profile=profile)
+        def is_odd(n):
+            if n == 0:
+                return False
+            return is_even(n - 1)
+
+        @execute_iteratively(profile=profile)
+        def split_sum(low, high):
+            if high - low == 1:
+                return is_even(low) and low
+            middle = (low + high) // 2
+            return split_sum(low, middle) + split_sum(middle, high)
+
+        self.assertEqual(split_sum(0, 4), 2)
+        # 3 split_sum inner nodes, 4 leaves, is_even of 0 to 3 and is_odd
+        # of 0 to 2
+        self.assertEqual(len(profile), 3 + 4 + 4 + 3)
+        nodes = dict(
+            (a_node.describe(), a_node) for a_node in profile.nodes.values()
+        )
+        root = nodes['split_sum(0, 4)']
+        self.assertEqual((root.executions, root.replays), (2, 1))
+        self.assertEqual(
+            [a_node.describe() for a_node in (profile.nodes[key] for key in root.dependencies)],
+            ['split_sum(0, 2)', 'split_sum(2, 4)']
+        )
+        # calls between functions sharing the profile are edges too
+        self.assertEqual(
+            list(nodes['split_sum(3, 4)'].dependencies),
+            [nodes['is_even(3)'].key]
+        )
+        self.assertEqual(
+            list(nodes['is_even(3)'].dependencies),
+            [nodes['is_odd(2)'].key]
+        )
+        # is_even(1) was known by then, answered by the memo
+        self.assertEqual(nodes['is_odd(2)'].dependencies, {})
+        self.assertEqual(nodes['is_even(0)'].executions, 1)
+        self.assertEqual(nodes['is_even(0)'].dependencies, {})
+
+        self.assertEqual(
+            [a_node.describe() for a_node in profile.top(3, by='replays')],
+            ['split_sum(0, 4)', 'split_sum(0, 2)', 'split_sum(2, 4)']
+        )
+        self.assertTrue(profile.top(1, by='seconds')[0].seconds > 0)
+        self.assertRaises(ValueError, profile.top, 3, 'calls')
+        summary = profile.summary(2)
+        self.assertTrue('most replayed:' in summary)
+        self.assertTrue('most expensive:' in summary)
+
+        # the critical path runs from the root, through waits, to a leaf
+        path = profile.critical_path()
+        self.assertTrue(path[0] is root)
+        for waiting, waited_on in zip(path, path[1:]):
+            self.assertTrue(waited_on.key in waiting.dependencies)
+        self.assertEqual(path[-1].dependencies, {})
+
+        exported = json.loads(profile.to_json())
+        self.assertEqual(len(exported['nodes']), len(profile))
+        self.assertEqual(exported['nodes'][0]['call'], 'split_sum(0, 4)')
+        self.assertEqual(exported['nodes'][0]['executions'], 2)
+        self.assertEqual(
+            len(exported['edges']),
+            sum(len(a_node.dependencies) for a_node in profile.nodes.values())
+        )
+        self.assertTrue([0, 1] in exported['edges'])
+        self.assertEqual(exported['critical_path'][0], 0)
+
+        dot = profile.to_dot()
+        self.assertTrue(dot.startswith('digraph reitercurse {'))
+        self.assertTrue('n0 [label="split_sum(0, 4)\\nexecutions 2, replays 1' in dot)
+        self.assertTrue('n0 -> n1;' in dot)
+        self.assertTrue('style=bold' in dot)
+
+        profile.clear()
+        self.assertEqual(len(profile), 0)
+        self.assertEqual(profile.critical_path(), [])
+
+    def test_execute_iteratively_bounded_cache(self):
+        @execute_iteratively(maxsize=3)
+        def ifib(n):
+            if n < 3:
+                return n
+            return ifib(n - 1) + ifib(n - 2)
+
+        a, b = 1, 2
+        for n in range(3, 3001):
+            a, b = b, a + b
+
+        # far more results are needed along the way than the cache may keep
+        self.assertEqual(ifib(3000), b)
+        info = ifib.cache_info()
+        self.assertEqual(info.maxsize, 3)
+        self.assertEqual(info.currsize, 3)
+        self.assertTrue(info.hits > 0)
+        self.assertTrue(info.misses > 0)
+
+        ifib.cache_clear()
+        self.assertEqual(ifib.cache_info(), (0, 0, 3, 0))
+        self.assertEqual(ifib(10), 89)
+
+    def test_execute_iteratively_decorating_again(self):
+        def square(n):
+            return n * n
+
+        unbounded = execute_iteratively(square)
+        bounded = execute_iteratively(maxsize=1)(square)
+        self.assertEqual(unbounded.map(range(5)), [0, 1, 4, 9, 16])
+        self.assertEqual(bounded.map(range(5)), [0, 1, 4, 9, 16])
+        # each decoration has its own memo and settings, none on square
+        self.assertEqual(unbounded.cache_info(), (0, 5, None, 5))
+        self.assertEqual(bounded.cache_info(), (0, 5, 1, 1))
+        self.assertFalse(hasattr(square, 'make_result_cache'))
+        self.assertEqual(square(3), 9)
+
+    def test_execute_iteratively_bounded_cache_eviction_order(self):
+        @execute_iteratively(maxsize=2)
+        def lru_square(n):
+            return n * n
+
+        @execute_iteratively(maxsize=2, policy='fifo')
+        def fifo_square(n):
+            return n * n
+
+        for square in (lru_square, fifo_square):
+            square(1)
+            square(2)
+            square(1)
+            square(3)
+            self.assertEqual(square.cache_info().currsize, 2)
+            square(1)
+            square(2)
+        # lru kept 1 around because it was used more recently than 2
+        self.assertEqual(lru_square.cache_info().hits, 2)
+        self.assertEqual(fifo_square.cache_info().hits, 1)
+
+        self.assertRaises(
+            ValueError,
+            execute_iteratively(maxsize=2, policy='random'),
+            lru_square
+        )
+
+    def test_execute_iteratively_evaluation_cache(self):
+        cache_sizes = []
+
+        def quicksort(value_sequence):
+            cache_sizes.append(this_quicksort.cache_info().currsize)
+            if not value_sequence:
+                return []
+            pivots = [x for x in value_sequence if x == value_sequence[0]]
+            lesser = this_quicksort(
+                [x for x in value_sequence if x < value_sequence[0]]
+            )
+            greater = this_quicksort(
+                [x for x in value_sequence if x > value_sequence[0]]
+            )
+            return lesser + pivots + greater
+
+        this_quicksort = memo_quicksort = execute_iteratively(quicksort)
+        self.assertEqual(memo_quicksort(list(range(500, 0, -1))), list(range(1, 501)))
+        # every sublist and its sorted form is still held
+        self.assertEqual(memo_quicksort.cache_info().currsize, 501)
+
+        del cache_sizes[:]
+        this_quicksort = evaluation_quicksort = execute_iteratively(
+            quicksort,
+            cache='evaluation'
+        )
+        self.assertEqual(
+            evaluation_quicksort(list(range(500, 0, -1))),
+            list(range(1, 501))
+        )
+        # only the results of the frames being replayed were ever held
+        self.assertTrue(max(cache_sizes) <= 2)
+        self.assertEqual(evaluation_quicksort.cache_info().currsize, 0)
+
+        self.assertRaises(
+            ValueError,
+            execute_iteratively(cache='evaluation', maxsize=10),
+            quicksort
+        )
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc is unavailable')
+    def test_execute_iteratively_evaluation_cache_memory(self):
+        def traced_memory(decorator, size):
+            @decorator
+            def quicksort(value_sequence):
+                if not value_sequence:
+                    return []
+                pivots = [x for x in value_sequence if x == value_sequence[0]]
+                lesser = quicksort(
+                    [x for x in value_sequence if x < value_sequence[0]]
+                )
+                greater = quicksort(
+                    [x for x in value_sequence if x > value_sequence[0]]
+                )
+                return lesser + pivots + greater
+
+            value_sequence = list(range(size, 0, -1))
+            tracemalloc.start()
+            try:
+                result = quicksort(value_sequence)
+                # the traceback cycles of caught KeyErrors are not what's
+                # being measured
+                gc.collect()
+                # (memory still held once the result is out, peak memory)
+                return tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        memo = execute_iteratively
+        evaluation = execute_iteratively(cache='evaluation')
+        memo_small, memo_small_peak = traced_memory(memo, 400)
+        memo_large, memo_large_peak = traced_memory(memo, 800)
+        evaluation_small, evaluation_small_peak = traced_memory(evaluation, 400)
+        evaluation_large, evaluation_large_peak = traced_memory(evaluation, 800)
+
+        # doubling the input quadruples what the memo keeps hold of
+        self.assertTrue(memo_large > 3 * memo_small)
+        # while the evaluation scoped cache keeps nothing beyond the result
+        self.assertTrue(evaluation_large < 3 * evaluation_small)
+        self.assertTrue(evaluation_large * 20 < memo_large)
+        self.assertTrue(evaluation_large_peak < memo_large_peak)
+
+    def test_execute_iteratively_shared_cache(self):
+        bodies = []
+        start = threading.Event()
+
+        @execute_iteratively(shared=True)
+        def split_sum(low, high):
+            start.wait()
+            bodies.append((low, high))
+            if high - low == 1:
+                return low
+            middle = (low + high) // 2
+            return split_sum(low, middle) + split_sum(middle, high)
+
+        results = []
+
+        def worker():
+            results.append(split_sum(0, 2048))
+
+        workers = [threading.Thread(target=worker) for x in range(4)]
+        for a_worker in workers:
+            a_worker.start()
+        start.set()
+        for a_worker in workers:
+            a_worker.join()
+
+        self.assertEqual(results, [sum(range(2048))] * 4)
+        # no body was executed by more than one thread: the totals are
+        # exactly those of a single thread
+        self.assertEqual(len(bodies), 2 * 2047 + 2048)
+        self.assertEqual(split_sum.cache_info().currsize, 2047 + 2048)
+
+        # a thread that starts afterwards finds everything already there
+        def late_worker():
+            results.append(split_sum(0, 1024))
+        a_worker = threading.Thread(target=late_worker)
+        a_worker.start()
+        a_worker.join()
+        self.assertEqual(results[-1], sum(range(1024)))
+        self.assertEqual(len(bodies), 2 * 2047 + 2048)
+
+    def test_execute_iteratively_shared_cache_failure(self):
+        attempts = []
+
+        @execute_iteratively(shared=True)
+        def fragile(n):
+            if n == 0:
+                attempts.append(threading.current_thread())
+                if len(attempts) == 1:
+                    raise ValueError('first attempt fails')
+                return 0
+            return fragile(n - 1) + 1
+
+        self.assertRaises(ValueError, fragile, 500)
+
+        results = []
+
+        def worker():
+            results.append(fragile(500))
+        a_worker = threading.Thread(target=worker)
+        a_worker.start()
+        a_worker.join()
+        # the abandoned claims didn't leave the other thread waiting
+        self.assertEqual(results, [500])
+        self.assertEqual(len(attempts), 2)
+
+        self.assertRaises(
+            ValueError,
+            execute_iteratively(shared=True, maxsize=10),
+            fragile
+        )
+
+    def test_execute_iteratively_persistent_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'memo.sqlite')
+        bodies = []
+
+        def new_process():
+            # a fresh decoration stands in for the same function in another
+            # process: it starts with an empty memo
+            @execute_iteratively(store=SqliteStore(path, batch_size=50))
+            def isum(values):
+                bodies.append(1)
+                if not values:
+                    return 0
+                return values[0] + isum(values[1:])
+            return isum
+
+        isum = new_process()
+        self.assertEqual(isum(list(range(300))), sum(range(300)))
+        self.assertEqual(len(bodies), 300 * 2 + 1)
+
+        isum = new_process()
+        del bodies[:]
+        self.assertEqual(isum(list(range(300))), sum(range(300)))
+        self.assertEqual(len(bodies), 0)
+        # part of the way down is known as well
+        self.assertEqual(isum(list(range(200, 300))), sum(range(200, 300)))
+        self.assertEqual(len(bodies), 0)
+        # so a longer list only needs its own body, which reads the rest
+        # straight from the store without even being replayed
+        self.assertEqual(isum([-1] + list(range(300))), sum(range(300)) - 1)
+        self.assertEqual(len(bodies), 1)
+
+        def new_scaled_process():
+            @execute_iteratively(store=SqliteStore(path))
+            def scaled(n, scale=1, offsets={}):
+                bodies.append(1)
+                if n == 0:
+                    return offsets.get('start', 0)
+                return scaled(n - 1, scale=scale, offsets=offsets) + scale
+            return scaled
+
+        # kwargs, frozen dicts among them, make keys too
+        scaled = new_scaled_process()
+        del bodies[:]
+        self.assertEqual(scaled(5, scale=2, offsets={'start': 1}), 11)
+        self.assertEqual(scaled(5, scale=3), 15)
+        scaled = new_scaled_process()
+        body_count = len(bodies)
+        self.assertEqual(scaled(5, scale=2, offsets={'start': 1}), 11)
+        self.assertEqual(scaled(5, scale=3), 15)
+        self.assertEqual(len(bodies), body_count)
+
+    def test_sqlite_store_max_entries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = SqliteStore(
+            os.path.join(directory, 'memo.sqlite'),
+            max_entries=100,
+            batch_size=10
+        )
+
+        bodies = []
+
+        @execute_iteratively(store=store)
+        def ifact(n):
+            bodies.append(n)
+            if n < 2:
+                return 1
+            return ifact(n - 1) * n
+
+        expected = ifact(1000)
+        self.assertEqual(len(store), 100)
+
+        ifact.cache_clear()
+        del bodies[:]
+        # the most recently written results were kept
+        self.assertEqual(ifact(1000), expected)
+        self.assertEqual(ifact(901), expected // reduce_product(902, 1000))
+        self.assertEqual(bodies, [])
+        # while the oldest were deleted
+        ifact(900)
+        self.assertEqual(bodies[0], 900)
+
+    def test_execute_iteratively_parallel(self):
+        def split_sum_with(executor, **kwargs):
+            threads_used = set()
+
+            @execute_iteratively(
+                parallel=executor,
+                cost=lambda low, high: high - low,
+                **kwargs
+            )
+            def split_sum(low, high):
+                threads_used.add(threading.current_thread())
+                if high - low == 1:
+                    return low
+                middle = (low + high) // 2
+                return split_sum(low, middle) + split_sum(middle, high)
+
+            self.assertEqual(split_sum(0, 1024), sum(range(1024)))
+            # what the workers found was taken into this thread's memo
+            self.assertEqual(split_sum.cache_info().currsize, 2 * 1024 - 1)
+            return threads_used
+
+        executor = ThreadExecutor()
+        threads_used = split_sum_with(executor, parallel_threshold=64)
+        # only the halves of 1024, 512, 256 and 128 were big enough to share
+        # out.  Of each pair, the next to be resolved stayed behind, and the
+        # workers don't share out any further
+        self.assertEqual(executor.submitted, 4)
+        self.assertEqual(len(threads_used), 1 + 4)
+
+        executor = ThreadExecutor()
+        threads_used = split_sum_with(
+            executor,
+            parallel_threshold=64,
+            parallel_grain=128
+        )
+        # the four quarters were split further, each sending out one half
+        # of 128, then one half of 64 of the other half
+        self.assertEqual(executor.submitted, 8)
+        self.assertEqual(len(threads_used), 1 + 8)
+
+    @unittest.skipIf(fork_context is None, 'worker processes cannot be forked')
+    def test_execute_iteratively_parallel_processes(self):
+        global parallel_quicksort
+        raw_quicksort = parallel_quicksort
+        executor = ProcessPoolExecutor(2, mp_context=fork_context)
+        try:
+            parallel_quicksort = execute_iteratively(
+                raw_quicksort,
+                parallel=executor,
+                parallel_threshold=100,
+                parallel_grain=500,
+                cost=len
+            )
+            values = [(x * 7919) % 2003 for x in range(2003)]
+            self.assertEqual(parallel_quicksort(values), sorted(values))
+            executor_memo_size = parallel_quicksort.cache_info().currsize
+            # the sub-problems sorted by worker processes are known here
+            # too, just as if they had all been sorted in this one
+            serial_quicksort = execute_iteratively(raw_quicksort)
+            parallel_quicksort = serial_quicksort
+            serial_quicksort(values)
+            self.assertEqual(
+                executor_memo_size,
+                serial_quicksort.cache_info().currsize
+            )
+        finally:
+            parallel_quicksort = raw_quicksort
+            executor.shutdown()
+
+    @unittest.skipIf(asyncio is None, 'asyncio is unavailable')
+    def test_execute_iteratively_evaluate_async(self):
+        @execute_iteratively(steps_per_slice=100)
+        def ifact(n):
+            if n < 2:
+                return 1
+            return ifact(n - 1) * n
+
+        @execute_iteratively(steps_per_slice=100)
+        def isum(n):
+            if n < 1:
+                return 0
+            return isum(n - 1) + n
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        turns_taken = []
+
+        def take_a_turn():
+            turns_taken.append(1)
+            loop.call_soon(take_a_turn)
+        loop.call_soon(take_a_turn)
+
+        # two evaluations interleaved on the one thread, each with a
+        # stack of its own
+        results = loop.run_until_complete(asyncio.gather(
+            ifact.evaluate_async(3000),
+            isum.evaluate_async(3000),
+        ))
+        self.assertEqual(results, [reduce_product(1, 3000), sum(range(3001))])
+        # 3000 frames each, discovered then replayed, 100 at a time
+        self.assertTrue(len(turns_taken) >= 6000 // 100)
+        # the memo is there for everyone afterwards
+        self.assertEqual(
+            loop.run_until_complete(ifact.evaluate_async(2999)),
+            reduce_product(1, 2999)
+        )
+        self.assertEqual(ifact(3000), reduce_product(1, 3000))
+
+    @unittest.skipIf(asyncio is None, 'asyncio is unavailable')
+    def test_evaluate_async_cancelled(self):
+        def sum_to(n):
+            if n < 1:
+                return 0
+            return i_sum_to(n - 1) + n
+
+        closed = []
+
+        def generator_sum_to(n):
+            try:
+                if n < 1:
+                    yield 0
+                else:
+                    yield (yield g_sum_to(n - 1)) + n
+            finally:
+                closed.append(n)
+        g_sum_to = execute_as_generator(steps_per_slice=100)(generator_sum_to)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+
+        def cancel_part_way(awaitable):
+            task = asyncio.ensure_future(awaitable)
+            for _ in range(5):
+                loop.run_until_complete(asyncio.sleep(0))
+            self.assertFalse(task.done())
+            task.cancel()
+            self.assertRaises(
+                asyncio.CancelledError,
+                loop.run_until_complete,
+                task
+            )
+
+        # the pins are let go of, so the memo is back within bounds
+        i_sum_to = execute_iteratively(maxsize=5, steps_per_slice=100)(sum_to)
+        cancel_part_way(i_sum_to.evaluate_async(5000))
+        self.assertEqual(get_result_cache(i_sum_to.defining_function).pins, {})
+        self.assertEqual(i_sum_to(100), sum(range(101)))
+        self.assertTrue(i_sum_to.cache_info().currsize <= 5)
+
+        # and the claims, so another thread doesn't wait on them forever
+        i_sum_to = execute_iteratively(shared=True, steps_per_slice=100)(sum_to)
+        cancel_part_way(i_sum_to.evaluate_async(5000))
+        results = []
+        other = threading.Thread(target=lambda: results.append(i_sum_to(5000)))
+        other.daemon = True
+        other.start()
+        other.join(10)
+        self.assertEqual(results, [sum(range(5001))])
+
+        # suspended generators are closed
+        cancel_part_way(g_sum_to.evaluate_async(5000))
+        self.assertTrue(len(closed) > 0)
+        self.assertEqual(sorted(closed), list(range(5000 - len(closed) + 1, 5001)))
+
+    @unittest.skipIf(
+        sys.version_info < (3, 5),
+        'async def requires Python 3.5'
+    )
+    def test_execute_as_generator_async_def(self):
+        bodies = []
+        namespace = {
+            'asyncio': asyncio,
+            'bodies': bodies,
+            'execute_as_generator': execute_as_generator,
+        }
+        exec(ASYNC_FUNCTIONS, namespace)
+        afact = namespace['afact']
+        afib = namespace['afib']
+        await_failing = namespace['await_failing']
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        results = loop.run_until_complete(asyncio.gather(afact(5000), afib(1000)))
+        self.assertEqual(results[0], reduce_product(1, 5000))
+        a, b = 1, 2
+        for n in range(3, 1001):
+            a, b = b, a + b
+        self.assertEqual(results[1], b)
+        # each coroutine ran once, suspended and resumed rather than replayed
+        self.assertEqual(sorted(bodies), list(range(1, 5001)))
+
+        # a failure of something awaited is raised in the coroutine that
+        # awaited it, and in those below it until one catches it
+        def failing_later():
+            failing = loop.create_future()
+            loop.call_later(0.01, failing.set_exception, ValueError('failed'))
+            return failing
+        for catch_at, expected in ((0, 5), (3, -3 + 2)):
+            self.assertEqual(
+                loop.run_until_complete(
+                    await_failing.evaluate_async(5, failing_later(), catch_at)
+                ),
+                expected
+            )
+        self.assertRaises(
+            ValueError,
+            loop.run_until_complete,
+            await_failing(5, failing_later(), None)
+        )
+
+        # generator functions can be evaluated in slices too
+        @execute_as_generator
+        def gfact(n):
+            if n < 2:
+                yield 1
+            else:
+                result = yield gfact(n - 1)
+                yield result * n
+        self.assertEqual(
+            loop.run_until_complete(gfact.evaluate_async(3000)),
+            reduce_product(1, 3000)
+        )
+
+        # but without an event loop, a coroutine that awaits anything other
+        # than a recursive call can't be finished
+        @execute_as_generator
+        def gfact_by_afact(n):
+            result = yield afact(n)
+            yield result
+        self.assertRaises(RuntimeError, gfact_by_afact, 6000)